@@ -1,7 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict, namedtuple
 from functools import wraps
+import threading
+import time
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+MISSING = object()
+KWARGS_MARK = object()
+
 
 def disable(func):
     '''
@@ -36,19 +45,97 @@ def countcalls(func):
     return inner
 
 
-def memo(func):
+def memo(func=None, maxsize=None, ttl=None):
     '''
     Memoize a function so that it caches all return values for
-    faster future lookups.
+    faster future lookups. Can be used bare or with options:
+
+    @memo(maxsize=1024, ttl=60)
+    def fetch(url):
+        ....
+
+    maxsize bounds the cache, the least recently used value is evicted
+    first; ttl is the number of seconds a value stays valid. Concurrent
+    calls with the same arguments compute the value only once.
+
+    >>> fetch.cache_info()
+    CacheInfo(hits=3, misses=1, evictions=0, maxsize=1024, currsize=1)
+    >>> fetch.cache_clear()
+
     '''
-    cache = {}
+    if func is None:
+        return lambda func: memo(func, maxsize, ttl)
+
+    cache = OrderedDict()
+    pending = {}
+    lock = threading.Lock()
+    stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def lookup(key):
+        # called under lock, returns MISSING for absent or expired values
+        entry = cache.get(key, MISSING)
+        if entry is MISSING:
+            return MISSING
+        value, expires = entry
+        if expires is not None and expires <= time.monotonic():
+            del cache[key]
+            stats['evictions'] += 1
+            return MISSING
+        if maxsize is not None:
+            cache.move_to_end(key)
+        return value
+
     @wraps(func)
     def inner(*args, **kwargs):
-        key = (args, frozenset(kwargs.items()))
-        if key not in cache:
-            ret = func(*args, **kwargs)
-            cache[key] = ret
-        return cache[key]
+        # positional-only calls are keyed by the args tuple itself
+        key = args + (KWARGS_MARK, frozenset(kwargs.items())) if kwargs else args
+        while True:
+            with lock:
+                value = lookup(key)
+                if value is not MISSING:
+                    stats['hits'] += 1
+                    return value
+                computing = pending.get(key)
+                if computing is None:
+                    computing = pending[key] = threading.Event()
+                    stats['misses'] += 1
+                    break
+            # another thread computes this key, take its value when it is done
+            computing.wait()
+
+        try:
+            value = func(*args, **kwargs)
+            with lock:
+                now = time.monotonic()
+                if ttl is not None and maxsize is None:
+                    # without LRU moves the oldest entries expire first
+                    while cache:
+                        oldest = next(iter(cache.values()))
+                        if oldest[1] > now:
+                            break
+                        cache.popitem(last=False)
+                        stats['evictions'] += 1
+                cache[key] = (value, None if ttl is None else now + ttl)
+                if maxsize is not None and len(cache) > maxsize:
+                    cache.popitem(last=False)
+                    stats['evictions'] += 1
+            return value
+        finally:
+            with lock:
+                del pending[key]
+            computing.set()
+
+    def cache_info():
+        with lock:
+            return CacheInfo(stats['hits'], stats['misses'], stats['evictions'], maxsize, len(cache))
+
+    def cache_clear():
+        with lock:
+            cache.clear()
+            stats.update(hits=0, misses=0, evictions=0)
+
+    inner.cache_info = cache_info
+    inner.cache_clear = cache_clear
     return inner
 
 
@@ -0,0 +1,86 @@
+import unittest
+import threading
+import time
+from deco import memo
+
+
+class TestMemo(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def square(self, x):
+        self.calls.append(x)
+        return x * x
+
+    def test_memo(self):
+        square = memo(self.square)
+        self.assertEqual([square(2), square(2), square(x=3), square(x=3)], [4, 4, 9, 9])
+        self.assertEqual(self.calls, [2, 3])
+        info = square.cache_info()
+        self.assertEqual((info.hits, info.misses, info.evictions, info.maxsize, info.currsize), (2, 2, 0, None, 2))
+
+    def test_maxsize(self):
+        square = memo(maxsize=2)(self.square)
+        square(1)
+        square(2)
+        square(1)
+        square(3)
+        # 2 is the least recently used value
+        square(1)
+        square(2)
+        self.assertEqual(self.calls, [1, 2, 3, 2])
+        self.assertEqual(square.cache_info().evictions, 2)
+        self.assertEqual(square.cache_info().currsize, 2)
+
+    def test_ttl(self):
+        square = memo(ttl=0.05)(self.square)
+        for x in range(100):
+            square(x)
+        square(0)
+        time.sleep(0.1)
+        square(0)
+        self.assertEqual(self.calls, list(range(100)) + [0])
+        # expired values of other arguments are dropped too
+        self.assertEqual(square.cache_info().currsize, 1)
+        self.assertEqual(square.cache_info().evictions, 100)
+
+    def test_cache_clear(self):
+        square = memo(maxsize=10)(self.square)
+        square(2)
+        square(2)
+        square.cache_clear()
+        info = square.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (0, 0, 0))
+        square(2)
+        self.assertEqual(self.calls, [2, 2])
+
+    def test_concurrent_misses(self):
+        def slow_square(x):
+            time.sleep(0.05)
+            return self.square(x)
+
+        square = memo(slow_square)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(square(3))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [9] * 8)
+        self.assertEqual(self.calls, [3])
+        self.assertEqual(square.cache_info().misses, 1)
+
+    def test_exception(self):
+        @memo
+        def fail(x):
+            self.calls.append(x)
+            raise ValueError(x)
+
+        self.assertRaises(ValueError, fail, 1)
+        self.assertRaises(ValueError, fail, 1)
+        self.assertEqual(self.calls, [1, 1])
+        self.assertEqual(fail.cache_info().currsize, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+from datetime import datetime, timedelta
+import gzip
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+import log_analyzer
+
+LINE_TEMPLATE = '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" 200 927 "-" ' \
+                '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" ' \
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" {request_time}\n'
+
+UI_SHORT_TEMPLATE = '{ip} {user}  - [{time_local}] "{method} {url} HTTP/1.1" {status} {size} "{referer}" ' \
+                    '"{user_agent}" "-" "{request_id}" "{rb_user}" {request_time}\n'
+
+URL_PATTERNS = [
+    '/api/v2/banner/{id}',
+    '/api/v2/group/{id}/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28',
+    '/api/v2/slot/{id}/groups',
+    '/api/1/campaigns/?id={id}',
+    '/export/appinstall_raw/2017-06-{day:02d}/',
+    '/accounts/login/?next=/agency/campaigns/{id}/',
+]
+
+USER_AGENTS = [
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36',
+    'python-requests/2.13.0',
+    'Slotovod',
+    '-',
+]
+
+MALFORMED_LINES = [
+    '',
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "-" 400 0 "-" "-" "-" "-" "-" 0.000',
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 927 "-" "Lynx" "-"',
+    '\x16\x03\x01\x00\xa5\x01\x00\x00\xa1\x03\x03',
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=200000, help='number of lines per run')
+    parser.add_argument('--engines', action='store_true', help='compare aggregation engines instead of parsers')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per parser, the best one is reported')
+    parser.add_argument('--suite', action='store_true', help='time every pipeline stage on a generated log')
+    parser.add_argument('--generate', metavar='PATH', help='only write a generated log to PATH')
+    parser.add_argument('--urls', type=int, default=10000, help='distinct urls in a generated log')
+    parser.add_argument('--zipf', type=float, default=1.1, help='zipf exponent of the url popularity')
+    parser.add_argument('--malformed', type=float, default=0.001, help='share of malformed lines')
+    parser.add_argument('--gzip', action='store_true', help='gzip the generated log')
+    parser.add_argument('--save', metavar='PATH', help='save the suite results as a JSON baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare the suite results with a saved baseline')
+    return parser.parse_args()
+
+
+def generate_lines(count, urls=10000, zipf=1.1, malformed=0.0, seed=0):
+    # urls popularity follows the Zipf law, request times are log-normal
+    rnd = random.Random(seed)
+    url_pool = [rnd.choice(URL_PATTERNS).format(id=rnd.randint(1, 10 ** 7), day=rnd.randint(1, 30))
+                for _ in range(urls)]
+    cum_weights = list(itertools.accumulate(1.0 / rank ** zipf for rank in range(1, urls + 1)))
+    day_start = datetime(2017, 6, 29)
+    for number, url in enumerate(rnd.choices(url_pool, cum_weights=cum_weights, k=count)):
+        if malformed and rnd.random() < malformed:
+            yield rnd.choice(MALFORMED_LINES) + '\n'
+            continue
+        time_local = (day_start + timedelta(seconds=86400 * number // count)).strftime('%d/%b/%Y:%H:%M:%S +0300')
+        yield UI_SHORT_TEMPLATE.format(
+            ip='.'.join(str(rnd.randint(1, 254)) for _ in range(4)),
+            user=rnd.choice(['-', '3b81f63526fa8']),
+            time_local=time_local,
+            method=rnd.choice(['GET', 'GET', 'GET', 'POST']),
+            url=url,
+            status=rnd.choice([200, 200, 200, 200, 301, 404, 500]),
+            size=rnd.randint(0, 100000),
+            referer=rnd.choice(['-', 'https://rb.mail.ru/api/v2/']),
+            user_agent=rnd.choice(USER_AGENTS),
+            request_id='{}-{}-4708-{}'.format(1498683600 + number, rnd.randint(10 ** 9, 4 * 10 ** 9),
+                                             rnd.randint(10 ** 6, 10 ** 7)),
+            rb_user=rnd.choice(['-', '1d63d3cf8b6', 'dc7161be3']),
+            request_time='{:.3f}'.format(rnd.lognormvariate(-2.0, 1.2)))
+
+
+def generate_log(path, lines, urls=10000, zipf=1.1, malformed=0.0, compress=False, seed=0):
+    opener = gzip.open if compress else open
+    with opener(path, 'wt', encoding='utf-8') as log:
+        log.writelines(generate_lines(lines, urls, zipf, malformed, seed))
+    return path
+
+
+def sample_lines(count, seed=0):
+    rnd = random.Random(seed)
+    return [LINE_TEMPLATE.format(url='/api/v2/banner/{}'.format(rnd.randint(1, 10000)),
+                                 request_time='{:.3f}'.format(rnd.random()))
+            for _ in range(count)]
+
+
+def parserline_triple_match(line):
+    # the original parserline, kept as the reference point
+    if not log_analyzer.LOG_ROW_RE.match(line):
+        return None
+    url_path = log_analyzer.LOG_ROW_RE.match(line).group(4)
+    request_time = float(log_analyzer.LOG_ROW_RE.match(line).group(5))
+    return url_path, request_time
+
+
+def bench_parser(parser, lines, repeat):
+    # lines are raw bytes as read from the log, str parsers pay for decoding
+    decode = not getattr(parser, 'accepts_bytes', False)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            parser(line.decode('utf-8') if decode else line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def bench_engine(engine, parsed_lines, repeat):
+    config = log_analyzer.namedtuple('Config', ['REPORT_SIZE', 'ENGINE'])(REPORT_SIZE=1000, ENGINE=engine)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        list(log_analyzer.cals_statistic(iter(parsed_lines), config))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(parsed_lines) / best
+
+
+def compare_engines(args):
+    parsed_lines = [log_analyzer.parserline(line) for line in sample_lines(args.lines)]
+    baseline = bench_engine('python', parsed_lines, args.repeat)
+    for name in sorted(log_analyzer.AGGREGATION_ENGINES):
+        rate = bench_engine(name, parsed_lines, args.repeat)
+        print('{:<12} {:>12.0f} lines/sec  x{:.2f}'.format(name, rate, rate / baseline))
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_suite(args):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        expansion = '.gz' if args.gzip else ''
+        path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630' + expansion)
+        generate_log(path, args.lines, args.urls, args.zipf, args.malformed, args.gzip)
+        log_meta = log_analyzer.LogMeta(path=path, date='20170630', expansion=expansion)
+        config = log_analyzer.namedtuple('Config', ['REPORT_SIZE', 'REPORT_DIR'])(
+            REPORT_SIZE=1000, REPORT_DIR=os.path.join(tmp_dir, 'reports'))
+
+        stages = {}
+        with (gzip.open if args.gzip else open)(path, 'rb') as log:
+            raw_lines = log.readlines()
+        for name in sorted(log_analyzer.LINE_PARSERS):
+            stages['parserline.' + name] = bench_parser(log_analyzer.get_parser(name), raw_lines, args.repeat)
+        for name in sorted(log_analyzer.LINE_PARSERS):
+            elapsed = best_time(lambda: sum(1 for _ in log_analyzer.xreadlines(log_meta, None, parser=name)),
+                                args.repeat)
+            stages['xreadlines.' + name] = len(raw_lines) / elapsed
+        parsed_lines = list(log_analyzer.xreadlines(log_meta, None))
+        elapsed = best_time(lambda: list(log_analyzer.cals_statistic(iter(parsed_lines), config)), args.repeat)
+        stages['cals_statistic'] = len(parsed_lines) / elapsed
+        rows = list(log_analyzer.cals_statistic(iter(parsed_lines), config))
+        elapsed = best_time(lambda: log_analyzer.generate_report(iter(rows), config, log_meta,
+                                                                 log_analyzer.REPORT_TEMPLATE_PATH), args.repeat)
+        stages['generate_report'] = len(rows) / elapsed
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return {
+        'params': {'lines': args.lines, 'urls': args.urls, 'zipf': args.zipf, 'malformed': args.malformed,
+                   'gzip': args.gzip},
+        'python': platform.python_version(),
+        # lines/sec for the parsing stages and cals_statistic, rows/sec for generate_report
+        'stages': stages,
+    }
+
+
+def print_suite(results, baseline=None):
+    for stage, rate in sorted(results['stages'].items()):
+        line = '{:<28} {:>14.0f} /sec'.format(stage, rate)
+        if baseline and baseline['stages'].get(stage):
+            line += '  x{:.2f}'.format(rate / baseline['stages'][stage])
+        print(line)
+
+
+def main():
+    args = parse_args()
+    if args.generate:
+        generate_log(args.generate, args.lines, args.urls, args.zipf, args.malformed, args.gzip)
+        return
+    if args.suite:
+        results = run_suite(args)
+        baseline = None
+        if args.compare:
+            with open(args.compare) as baseline_file:
+                baseline = json.load(baseline_file)
+        print_suite(results, baseline)
+        if args.save:
+            with open(args.save, 'w') as results_file:
+                json.dump(results, results_file, indent=2, sort_keys=True)
+        return
+    if args.engines:
+        compare_engines(args)
+        return
+    lines = [line.encode('utf-8') for line in sample_lines(args.lines)]
+    baseline = bench_parser(parserline_triple_match, lines, args.repeat)
+    print('{:<12} {:>12.0f} lines/sec'.format('baseline', baseline))
+    for name in sorted(log_analyzer.LINE_PARSERS):
+        parser = log_analyzer.get_parser(name)
+        rate = bench_parser(parser, lines, args.repeat)
+        print('{:<12} {:>12.0f} lines/sec  x{:.2f}'.format(name, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
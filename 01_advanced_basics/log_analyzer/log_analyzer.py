@@ -2,14 +2,48 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-from collections import namedtuple, defaultdict
-from datetime import datetime
+import functools
+from array import array
+import contextlib
+from collections import namedtuple, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 import gzip
+import heapq
+import itertools
 import json
 import logging
+import math
+import mmap
+from operator import add, attrgetter, itemgetter
 from statistics import median
 import os
+import pickle
+from queue import Queue, Full
 import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import weakref
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 # log_format ui_short '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
 #                     '$status $body_bytes_sent "$http_referer" '
@@ -19,10 +53,79 @@ import re
 config = {
     'REPORT_SIZE': 1000,
     'REPORT_DIR': './reports',
-    'LOG_DIR': './log'
+    'LOG_DIR': './log',
+    'PARSER': 'regex',
+    'WORKERS': 1,
+    'GZIP_BLOCK_SIZE': 4 * 1024 * 1024,
+    'GZIP_QUEUE_SIZE': 8,
+    'AGGREGATION': 'exact',
+    'SKETCH_ACCURACY': 0.01,
+    'PERCENTILES': [],
+    'REPORT_SORT_KEY': 'time_avg',
+    'ENGINE': 'python',
+    'CHECKPOINT_PATH': './checkpoint/nginx-access-ui.pickle',
+    'CACHE_DIR': None,
+    'BACKFILL_WORKERS': os.cpu_count() or 1,
+    'ERRORS_LIMIT': 0.2,
+    'ERRORS_WARMUP_LINES': 10000,
+    'METRICS_TEXTFILE': None,
+    'URL_QUERY': 'keep',
+    'URL_KEEP_PARAMS': [],
+    'URL_COLLAPSE_IDS': False,
+    'URL_MAX_CARDINALITY': None,
+    'LOG_FORMAT': None,
+    'LOG_NAME_PATTERN': None,
+    'FOLLOW_WINDOWS': [60, 300, 3600],
+    'FOLLOW_BUCKET_SECONDS': 10,
+    'FOLLOW_INTERVAL': 10,
+    'FOLLOW_OUTPUT': 'html',
+    'COLUMNS_DIR': './columns',
+    'BREAKDOWNS': [],
+    'MAX_MEMORY_MB': None,
+    'SPILL_PARTITIONS': 16,
+    'SPILL_DIR': None,
+    'REPORT_DATA_FILE': False
 }
 
-REPORT_TEMPLATE_PATH =  "./template.html"
+# the template is looked up next to the script, not in the working directory
+REPORT_TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'template.html')
+
+CURRENT_LOG_NAME = 'nginx-access-ui.log'
+
+CURRENT_REPORT_NAME = 'report-current.html'
+
+LIVE_REPORT_NAME = 'report-live-{}.html'
+
+LIVE_JSON_NAME = 'live.json'
+
+FOLLOW_READ_SIZE = 1024 * 1024
+
+COLUMNS_REPORT_NAME = 'report-{}.{}.{}-columns.html'
+
+COLUMNS_META_NAME = 'meta.json'
+
+# column name -> array typecode, every column is a raw file of native numbers
+COLUMN_TYPES = (('url_id', 'I'), ('request_time', 'd'), ('timestamp', 'q'), ('status', 'H'), ('utc_offset', 'i'))
+
+COLUMNS_BATCH_SIZE = 64 * 1024
+
+BREAKDOWN_DIMENSIONS = ('status', 'hour')
+
+# approximate size of the aggregate of one url without its samples, measured with tracemalloc
+STORE_URL_BYTES = {'exact': 400, 'sketch': 1000}
+
+SPILL_CHECK_INTERVAL = 10000
+
+# a spilled partition is split for the merge into at most this many files
+SPILL_MAX_SPLITS = 64
+
+STATUS_CLASSES = range(1, 6)
+
+OTHER_URL = '(other)'
+
+# numeric and uuid path segments or query values
+URL_ID_RE = re.compile(r'(?<=[/=])(?:[0-9]+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})'
+                       r'(?=[/&;?#]|$)')
 
 LOG_NAME_RE = re.compile(r'(?P<name>^nginx-access-ui\.log-(?P<date>[0-9]+)?(?P<extension>\.gz)?)?$')
 
@@ -30,12 +133,72 @@ LOG_ROW_RE = re.compile(r'(^\S+ )\S+\s+\S+ (\[\S+ \S+\] )'
                 r'(\"\S+ (\S+) \S+\") \d+ \d+ \"\S+\" ' 
                 r'\".*\" \"\S+\" \"\S+\" \"\S+\" (\d+\.\d+)')
 
+LOG_ROW_BYTES_RE = re.compile(LOG_ROW_RE.pattern.encode('ascii'))
+
+# nginx log_format strings by name, LOG_FORMAT may also be a log_format string itself or 'json'
+LOG_FORMATS = {
+    'ui_short': '$remote_addr $remote_user  $http_x_real_ip [$time_local] "$request" '
+                '$status $body_bytes_sent "$http_referer" '
+                '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
+                '$request_time',
+}
+
+LOG_FORMAT_VARIABLE_RE = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+
+# variable -> (field, regex) for the fields the report is built from, the rest of a line is only skipped over
+LOG_FORMAT_FIELDS = {
+    'request': ('url', r'[^ "]+ (?P<url>[^ "]+) [^ "]+'),
+    'request_uri': ('url', r'(?P<url>[^ "]+)'),
+    'uri': ('url', r'(?P<url>[^ "]+)'),
+    'request_time': ('request_time', r'(?P<request_time>\d+(?:\.\d+)?)'),
+    'time_local': ('time_local', r'(?P<time_local>[^\]]+)'),
+    'status': ('status', r'(?P<status>\d{3})'),
+}
+
+REPORT_FIELDS = ('url', 'request_time')
+
+RECORD_FIELDS = ('url', 'request_time', 'time_local', 'status')
+
+NUMPY_BATCH_SIZE = 256 * 1024
+
+ERRORS_CHECK_INTERVAL = 1000
+
 LogMeta = namedtuple('LogMeta', ['path', 'date', 'expansion'])
 
+# url_count is the number of parsed lines, error_count of the lines that could not be parsed
+# breakdowns is None or Breakdowns collected with the store
+Statistic = namedtuple('Statistic', ['store', 'url_count', 'total_req_time', 'error_count', 'breakdowns'],
+                       defaults=(0, None))
+
+# accuracy is None for the exact aggregation, otherwise the relative accuracy of QuantileSketch
+# normalization is None or UrlNormalization applied to urls before the aggregation
+# breakdowns are the extra cuts of the report: 'status' and/or 'hour'
+# cache_accuracy is not None when exact samples are also sketched for the day cache
+AggregateOptions = namedtuple('AggregateOptions', ['accuracy', 'normalization', 'breakdowns', 'cache_accuracy'],
+                              defaults=(None, (), None))
+
+UrlNormalization = namedtuple('UrlNormalization', ['strip_query', 'keep_params', 'collapse_ids', 'max_cardinality'])
+
+# identity is (st_dev, st_ino) of the log, offset is the end of the last aggregated line
+Checkpoint = namedtuple('Checkpoint', ['identity', 'offset', 'options', 'statistic'])
+
+EXACT_AGGREGATION = AggregateOptions(accuracy=None)
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', dest='config_path', help='config path', default='/usr/local/etc/config.json')
+    parser.add_argument('--workers', dest='workers', type=int, help='parse a plain log in N processes')
+    parser.add_argument('--incremental', action='store_true',
+                        help='aggregate only the new lines of the current log and refresh its report')
+    parser.add_argument('--backfill', action='store_true', help='generate reports for every log that has none')
+    parser.add_argument('--range', dest='date_range',
+                        help='build one report for the days YYYYMMDD..YYYYMMDD from the cached aggregates')
+    parser.add_argument('--follow', action='store_true',
+                        help='tail the current log and refresh the reports of the last minutes')
+    parser.add_argument('--columns', dest='columns_date', metavar='YYYYMMDD',
+                        help='build a report of the day from its saved columns, the log is parsed only once')
+    parser.add_argument('--url-filter', dest='url_filter', metavar='REGEX', help='only urls matching REGEX')
     return parser.parse_args()
 
 
@@ -70,39 +233,82 @@ def merge_config(default_config, file_config):
     return result
 
 
-def find_last_log(config, LogMeta):
-    last_file = None
-    last_file_date = None
+# directory path -> (inode, mtime, scan result)
+DIR_INDEX_CACHE = {}
 
-    if not os.path.exists(config.LOG_DIR):
-        return None
 
-    for file_name in os.listdir(config.LOG_DIR):
-        match = LOG_NAME_RE.match(file_name)
-        if not match:
+def cached_scan(path, scan, key=None):
+    # a directory changes its mtime when a file is added or removed, so a scan result
+    # is reused until then; a just modified directory is not cached, its mtime may not tick yet.
+    # key tells apart different scans of the same directory
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return scan([])
+    cached = DIR_INDEX_CACHE.get((path, key))
+    if cached and cached[0] == stat.st_ino and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+    with os.scandir(path) as entries:
+        result = scan(entry.name for entry in entries)
+    if time.time() - stat.st_mtime > 1.0:
+        DIR_INDEX_CACHE[(path, key)] = (stat.st_ino, stat.st_mtime_ns, result)
+    return result
+
+
+def is_log_date(date):
+    # YYYYMMDD strings compare in the same order as the dates
+    return date is not None and len(date) == 8 and '01' <= date[4:6] <= '12' and '01' <= date[6:] <= '31'
+
+
+def log_name_re(config):
+    # LOG_NAME_PATTERN has to match a whole file name and capture the date as YYYYMMDD
+    # in the 'date' group or in 'year', 'month' and 'day', '.gz' in the 'extension' group
+    pattern = getattr(config, 'LOG_NAME_PATTERN', None)
+    return re.compile(pattern) if pattern else LOG_NAME_RE
+
+
+def index_logs(file_names, name_re=LOG_NAME_RE):
+    logs = {}
+    for file_name in file_names:
+        match = name_re.fullmatch(file_name)
+        if not match or not match.group(0):
             continue
-        date_parse = match.groupdict()['date']
-        file = match.groupdict()['name']
-        try:
-            date = datetime.strptime(date_parse, '%Y%m%d')
-        except ValueError:
-            logging.exception('Wrong date in log file', exc_info=True)
+        groups = match.groupdict()
+        date = groups.get('date') or ''.join(groups.get(part) or '' for part in ('year', 'month', 'day'))
+        if not is_log_date(date):
+            logging.error('Wrong date in log file {}'.format(file_name))
             continue
+        logs.setdefault(date, (file_name, groups.get('extension') or ''))
+    return logs
+
+
+def scan_logs(log_dir, name_re=LOG_NAME_RE):
+    return cached_scan(log_dir, functools.partial(index_logs, name_re=name_re), key=name_re.pattern)
 
-        if not last_file or date > last_file_date:
-            last_file = file
-            last_file_date = date
 
-    if not last_file:
+def scan_reports(report_dir):
+    return cached_scan(report_dir, frozenset)
+
+
+def find_last_log(config, LogMeta):
+    logs = scan_logs(config.LOG_DIR, log_name_re(config))
+    if not logs:
         return None
+    date = max(logs)
+    file_name, expansion = logs[date]
+    return LogMeta(path=os.path.join(config.LOG_DIR, file_name), date=date, expansion=expansion)
 
-    if last_file.split('.')[-1] == 'gz':
-        expansion = '.gz'
-    else:
-        expansion = ''
 
-    return LogMeta(path=os.path.join(config.LOG_DIR, last_file), date=datetime.strftime(last_file_date,'%Y%m%d'),
-                                            expansion=expansion)
+def find_unreported_logs(config):
+    logs = scan_logs(config.LOG_DIR, log_name_re(config))
+    reports = scan_reports(config.REPORT_DIR)
+    result = []
+    for date in sorted(logs):
+        file_name, expansion = logs[date]
+        log_meta = LogMeta(path=os.path.join(config.LOG_DIR, file_name), date=date, expansion=expansion)
+        if generate_report_name(log_meta) not in reports:
+            result.append(log_meta)
+    return result
 
 
 def generate_report_name(log_meta):
@@ -110,131 +316,2079 @@ def generate_report_name(log_meta):
 
 
 def check_current_report_done(log_meta, config):
-    report_name = generate_report_name(log_meta)
-    if report_name in os.listdir(config.REPORT_DIR):
-        return True
-    return False
+    return generate_report_name(log_meta) in scan_reports(config.REPORT_DIR)
 
 
 def parserline(line):
-    if not LOG_ROW_RE.match(line):
+    match = LOG_ROW_RE.match(line)
+    if not match:
         return None
-    url_path = LOG_ROW_RE.match(line).group(4)
-    request_time = float(LOG_ROW_RE.match(line).group(5))
-    result = (url_path, request_time)
-    return result
+    return match.group(4), float(match.group(5))
+
+
+def parserline_split(line):
+    # "$request" is the first quoted field and $request_time the last one,
+    # so both can be cut out by delimiters without running the full regex
+    start = line.find('"')
+    if start < 0:
+        return None
+    end = line.find('"', start + 1)
+    if end < 0:
+        return None
+    request = line[start + 1:end].split(' ')
+    if len(request) != 3:
+        return None
+    try:
+        request_time = float(line[line.rindex(' ') + 1:])
+    except ValueError:
+        return None
+    return request[1], request_time
+
+
+class BytesLineParser(object):
+    # parses raw lines from the log file, only the url is decoded
+    # and only once per distinct url while the cache is not full
+    accepts_bytes = True
+    cache_size = 100000
+
+    def __init__(self):
+        self.urls = {}
+
+    def decode_url(self, raw_url):
+        url = self.urls.get(raw_url)
+        if url is None:
+            try:
+                url = raw_url.decode('utf-8')
+            except UnicodeDecodeError:
+                return None
+            if len(self.urls) >= self.cache_size:
+                # random urls would grow the cache without a bound
+                self.urls.clear()
+            self.urls[raw_url] = url
+        return url
+
+
+class BytesRegexParser(BytesLineParser):
+    def __init__(self, row_re=LOG_ROW_BYTES_RE, url_group=4, time_group=5):
+        super().__init__()
+        self.row_re = row_re
+        # '^' has to match at the start of every line of a mapped log
+        self.mapped_re = re.compile(row_re.pattern, row_re.flags | re.MULTILINE)
+        self.url_group = url_group
+        self.time_group = time_group
+
+    def parse_match(self, match):
+        if not match:
+            return None
+        url = self.decode_url(match.group(self.url_group))
+        if url is None:
+            return None
+        return url, float(match.group(self.time_group))
+
+    def __call__(self, line):
+        return self.parse_match(self.row_re.match(line))
+
+    def parse_at(self, buffer, start, end):
+        # parses buffer[start:end] in place, without copying the line
+        return self.parse_match(self.mapped_re.match(buffer, start, end))
+
+
+class BytesSplitParser(BytesLineParser):
+    def __call__(self, line):
+        return self.parse_at(line, 0, len(line))
+
+    def parse_at(self, buffer, line_start, line_end):
+        start = buffer.find(b'"', line_start, line_end)
+        if start < 0:
+            return None
+        end = buffer.find(b'"', start + 1, line_end)
+        if end < 0:
+            return None
+        request = buffer[start + 1:end].split(b' ')
+        if len(request) != 3:
+            return None
+        try:
+            request_time = float(buffer[buffer.rfind(b' ', line_start, line_end) + 1:line_end])
+        except ValueError:
+            return None
+        url = self.decode_url(request[1])
+        if url is None:
+            return None
+        return url, request_time
+
+
+class JsonLinesParser(object):
+    # one JSON object per line, the url field may hold the whole request line
+    accepts_bytes = True
+
+    def __init__(self, url_field='request', time_field='request_time'):
+        self.url_field = url_field
+        self.time_field = time_field
+
+    def __call__(self, line):
+        try:
+            record = json_loads(line)
+            url = record[self.url_field]
+            request_time = float(record[self.time_field])
+        except (ValueError, KeyError, TypeError):
+            return None
+        if not isinstance(url, str):
+            return None
+        if ' ' in url:
+            request = url.split(' ')
+            if len(request) != 3:
+                return None
+            url = request[1]
+        return url, request_time
+
+
+def compile_log_format(log_format, required_fields=REPORT_FIELDS):
+    # builds a regex from an nginx log_format string: every variable matches up to the literal
+    # that follows it, and the regex ends right after the last required field
+    parts = ['^']
+    fields = set()
+    last_field_end = None
+    position = 0
+    for match in LOG_FORMAT_VARIABLE_RE.finditer(log_format):
+        parts.append(re.escape(log_format[position:match.start()]))
+        field, pattern = LOG_FORMAT_FIELDS.get((match.group(1) or match.group(2)).lower(), (None, None))
+        if field in required_fields and field not in fields:
+            parts.append(pattern)
+            fields.add(field)
+            last_field_end = len(parts)
+        else:
+            next_char = log_format[match.end():match.end() + 1]
+            parts.append('[^{}]*'.format(re.escape(next_char)) if next_char else '.*')
+        position = match.end()
+    if fields != set(required_fields):
+        raise ValueError('log_format has to contain {}'.format(
+            ', '.join('$request (or $request_uri)' if field == 'url' else '$' + field for field in required_fields)))
+    return re.compile(''.join(parts[:last_field_end]).encode('utf-8'))
+
+
+def format_parser(log_format, config=None):
+    if log_format == 'json':
+        return JsonLinesParser(getattr(config, 'JSON_URL_FIELD', 'request'),
+                               getattr(config, 'JSON_TIME_FIELD', 'request_time'))
+    log_format = LOG_FORMATS.get(log_format, log_format)
+    if '$' not in log_format:
+        raise ValueError('Unknown log format: {}'.format(log_format))
+    return BytesRegexParser(compile_log_format(log_format), url_group='url', time_group='request_time')
+
+
+class BytesRecordParser(BytesRegexParser):
+    # (url, request_time, timestamp, status, utc_offset) records, utc_offset is the zone of $time_local in seconds
+    def __init__(self, row_re):
+        super().__init__(row_re, url_group='url', time_group='request_time')
+        self.days = {}
+
+    def timestamp(self, time_local):
+        # $time_local is dd/Mon/yyyy:HH:MM:SS +zzzz, the date with the zone is converted once per day
+        if len(time_local) != 26:
+            raise ValueError('Wrong $time_local {!r}'.format(time_local))
+        day = time_local[:11] + time_local[20:]
+        day_start = self.days.get(day)
+        if day_start is None:
+            parsed = datetime.strptime(day.decode('ascii'), '%d/%b/%Y %z')
+            day_start = self.days[day] = (int(parsed.timestamp()), int(parsed.utcoffset().total_seconds()))
+        seconds = int(time_local[12:14]) * 3600 + int(time_local[15:17]) * 60 + int(time_local[18:20])
+        return day_start[0] + seconds, day_start[1]
+
+    def parse_match(self, match):
+        if not match:
+            return None
+        url = self.decode_url(match.group('url'))
+        if url is None:
+            return None
+        try:
+            timestamp, utc_offset = self.timestamp(match.group('time_local'))
+        except (ValueError, UnicodeDecodeError):
+            return None
+        return url, float(match.group('request_time')), timestamp, int(match.group('status')), utc_offset
+
+
+def record_parser(config):
+    log_format = getattr(config, 'LOG_FORMAT', None) or 'ui_short'
+    log_format = LOG_FORMATS.get(log_format, log_format)
+    if '$' not in log_format:
+        raise ValueError('Records can be parsed only from an nginx log_format, not {}'.format(log_format))
+    return BytesRecordParser(compile_log_format(log_format, RECORD_FIELDS))
+
+
+def config_parser(config):
+    # LOG_FORMAT takes precedence over PARSER, which only chooses how ui_short lines are parsed;
+    # the breakdowns need the records with the timestamp and the status
+    if getattr(config, 'BREAKDOWNS', None):
+        return record_parser(config)
+    log_format = getattr(config, 'LOG_FORMAT', None)
+    if log_format:
+        return format_parser(log_format, config)
+    return getattr(config, 'PARSER', 'regex')
+
+
+# plain functions are used as is, classes are instantiated per run
+LINE_PARSERS = {
+    'regex': parserline,
+    'split': parserline_split,
+    'bytes': BytesRegexParser,
+    'bytes_split': BytesSplitParser,
+}
+
+
+def get_parser(parser):
+    if not isinstance(parser, str):
+        parser_factory = parser
+    else:
+        try:
+            parser_factory = LINE_PARSERS[parser]
+        except KeyError:
+            raise ValueError('Unknown parser: {}'.format(parser))
+    if isinstance(parser_factory, type):
+        return parser_factory()
+    return parser_factory
+
+
+def read_gzip_blocks(path, block_size):
+    # yields blocks of complete lines, pigz inflates in its own process when it is installed
+    pigz = shutil.which('pigz')
+    if pigz:
+        process = subprocess.Popen([pigz, '-dc', path], stdout=subprocess.PIPE)
+        stream = process.stdout
+    else:
+        process = None
+        stream = gzip.open(path, 'rb')
+
+    finished = False
+    try:
+        tail = b''
+        while True:
+            block = stream.read(block_size)
+            if not block:
+                break
+            if tail:
+                block = tail + block
+            cut = block.rfind(b'\n') + 1
+            if cut:
+                yield block[:cut]
+                tail = block[cut:]
+            else:
+                tail = block
+        if tail:
+            yield tail
+        finished = True
+    finally:
+        stream.close()
+        if process:
+            if not finished:
+                process.kill()
+            if process.wait() and finished:
+                raise RuntimeError('pigz failed to decompress {}'.format(path))
+
 
+def iter_in_thread(iterable, queue_size):
+    # runs iterable in a background thread, items are handed over through a bounded queue
+    queue = Queue(maxsize=queue_size)
+    stopped = threading.Event()
+    end = object()
 
-def xreadlines(log_meta, logger, parser=parserline, errors_limit=None):
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(item):
+                    break
+        except Exception as e:
+            put(e)
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            put(end)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def split_chunk(chunk):
+    lines = chunk.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def iter_gzip_lines(path, block_size, queue_size):
+    for chunk in iter_in_thread(read_gzip_blocks(path, block_size), queue_size):
+        yield from split_chunk(chunk)
+
+
+def check_errors(total_lines, errors, errors_limit):
+    if errors_limit is not None and total_lines > 0 and errors / float(total_lines) > errors_limit:
+        raise RuntimeError('To much errors in log! {} of {} lines are not parsed'.format(errors, total_lines))
+
+
+@contextlib.contextmanager
+def map_log(path):
+    # yields None for an empty file, it can not be mapped
+    with open(path, 'rb') as log:
+        if not os.fstat(log.fileno()).st_size:
+            yield None
+            return
+        with mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def parse_mapped_lines(path, parse_at, start, end, source_metrics):
+    # scans the mapped log for newlines and parses every line in place
+    position = start
+    try:
+        with map_log(path) as mapped:
+            if mapped is None:
+                return
+            end = len(mapped) if end is None else min(end, len(mapped))
+            find = mapped.find
+            while position < end:
+                newline = find(b'\n', position, end)
+                if newline < 0:
+                    newline = end
+                yield parse_at(mapped, position, newline)
+                position = newline + 1
+    finally:
+        source_metrics['bytes'] = max(min(position, end), start) - start if end is not None else 0
+
+
+def parse_read_lines(log_meta, parser, start, end, block_size, queue_size, source_metrics):
+    decode = not getattr(parser, 'accepts_bytes', False)
+    read_bytes = 0
+    if log_meta.expansion == '.gz' and block_size:
+        opener = contextlib.closing(iter_gzip_lines(log_meta.path, block_size, queue_size))
+    elif log_meta.expansion == '.gz':
+        opener = gzip.open(log_meta.path, 'rb')
+    else:
+        opener = open(log_meta.path, 'rb')
+    try:
+        with opener as log:
+            if start:
+                log.seek(start)
+            position = start
+            for line in log:
+                if end is not None:
+                    if position >= end:
+                        break
+                    position += len(line)
+                read_bytes += len(line)
+                yield parser(line.decode('utf-8') if decode else line)
+    finally:
+        source_metrics['bytes'] = read_bytes
+
+
+def xreadlines(log_meta, logger, parser=parserline, errors_limit=None, start=0, end=None,
+               block_size=0, queue_size=8, warmup_lines=10000, metrics=None, use_mmap=True):
+    # start/end limit reading of a plain log to a byte range aligned to line boundaries,
+    # block_size enables the pipelined reader for gzipped logs.
+    # A plain log is mapped into memory when the parser can parse a line in place (parse_at).
+    # errors_limit is checked every ERRORS_CHECK_INTERVAL lines after the first warmup_lines,
+    # metrics dict receives the lines counts when the reading stops
+    parser = get_parser(parser)
     total_lines = 0
     processed = 0
     error = 0
-    opener = gzip.open(log_meta.path, 'rb') \
-                    if log_meta.expansion == '.gz' \
-                    else open(log_meta.path, 'rb')
-    with opener as log:
-        for line in log:
+    next_check = warmup_lines if errors_limit is not None else None
+    source_metrics = {}
+    parse_at = getattr(parser, 'parse_at', None)
+    if use_mmap and parse_at is not None and log_meta.expansion != '.gz':
+        parsed_lines = parse_mapped_lines(log_meta.path, parse_at, start, end, source_metrics)
+    else:
+        parsed_lines = parse_read_lines(log_meta, parser, start, end, block_size, queue_size, source_metrics)
+    try:
+        for parsed_line in parsed_lines:
+            if total_lines == next_check:
+                check_errors(total_lines, error, errors_limit)
+                next_check += ERRORS_CHECK_INTERVAL
             total_lines += 1
-            line = line.decode('utf-8')
-            parsed_line = parser(line)
             if not parsed_line:
                 error += 1
                 continue
 
             processed += 1
             yield parsed_line
+    finally:
+        parsed_lines.close()
+        if metrics is not None:
+            metrics.update(total_lines=total_lines, processed=processed, errors=error,
+                           bytes=source_metrics.get('bytes', 0))
+
+    check_errors(total_lines, error, errors_limit)
+
+
+class QuantileSketch(object):
+    '''
+    Mergeable quantile sketch with a relative error guarantee (DDSketch).
+
+    Values are counted in buckets with logarithmically growing bounds,
+    a quantile is estimated as the middle of its bucket. The estimate of
+    a quantile whose exact value is x lies within x * (1 +- accuracy).
+    Memory depends only on the range of values: with accuracy 0.01 all
+    times from 1 ms to 1 hour fit into about 760 buckets.
+    '''
+    __slots__ = ('accuracy', 'gamma', 'gamma_log', 'buckets', 'zero_count', 'count')
+
+    def __init__(self, accuracy=0.01):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.gamma_log = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def append(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) / self.gamma_log)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise ValueError('Can not merge sketches with different accuracy')
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantiles(self, qs):
+        result = []
+        keys = sorted(self.buckets)
+        for q in qs:
+            rank = q * (self.count - 1)
+            if rank < self.zero_count:
+                result.append(0.)
+                continue
+            seen = self.zero_count
+            for key in keys:
+                seen += self.buckets[key]
+                if seen > rank:
+                    break
+            result.append(2 * self.gamma ** key / (self.gamma + 1))
+        return result
+
+
+class SketchedSamples(object):
+    '''
+    Exact request times of an url together with their QuantileSketch,
+    so the day cache gets the sketches without a second pass over samples.
+    '''
+    __slots__ = ('values', 'sketch')
+
+    def __init__(self, accuracy):
+        self.values = array('d')
+        self.sketch = QuantileSketch(accuracy)
+
+    def append(self, value):
+        self.values.append(value)
+        self.sketch.append(value)
+
+    def extend(self, other):
+        if isinstance(other, SketchedSamples):
+            self.values.extend(other.values)
+            self.sketch.merge(other.sketch)
+            return
+        for value in other:
+            self.append(value)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+
+def exact_quantiles(samples, qs):
+    # linear interpolation between the closest ranks
+    samples = sorted(samples)
+    result = []
+    for q in qs:
+        rank = q * (len(samples) - 1)
+        low = int(rank)
+        high = min(low + 1, len(samples) - 1)
+        result.append(samples[low] + (samples[high] - samples[low]) * (rank - low))
+    return result
+
+
+def url_normalization(config):
+    normalization = UrlNormalization(strip_query=getattr(config, 'URL_QUERY', 'keep') == 'strip',
+                                     keep_params=tuple(getattr(config, 'URL_KEEP_PARAMS', None) or ()),
+                                     collapse_ids=getattr(config, 'URL_COLLAPSE_IDS', False),
+                                     max_cardinality=getattr(config, 'URL_MAX_CARDINALITY', None))
+    if not normalization.strip_query and not normalization.collapse_ids and not normalization.max_cardinality:
+        return None
+    return normalization
+
+
+def aggregate_options(config, day_cache=False):
+    # day_cache: the statistic is saved to CACHE_DIR, exact samples are sketched while they are aggregated
+    accuracy = None
+    cache_accuracy = None
+    if getattr(config, 'AGGREGATION', 'exact') == 'sketch':
+        accuracy = getattr(config, 'SKETCH_ACCURACY', 0.01)
+    elif day_cache and getattr(config, 'CACHE_DIR', None):
+        cache_accuracy = getattr(config, 'SKETCH_ACCURACY', 0.01)
+    breakdowns = tuple(getattr(config, 'BREAKDOWNS', None) or ())
+    for dimension in breakdowns:
+        if dimension not in BREAKDOWN_DIMENSIONS:
+            raise ValueError('Unknown breakdown: {}'.format(dimension))
+    return AggregateOptions(accuracy=accuracy, normalization=url_normalization(config), breakdowns=breakdowns,
+                            cache_accuracy=cache_accuracy)
+
+
+def url_id_placeholder(match):
+    return '{id}' if match.group(0).isdigit() else '{uuid}'
+
+
+class UrlNormalizer(object):
+    '''
+    Folds urls that differ only by ids and query params into one key.
+    After max_cardinality distinct keys every new one is counted as
+    OTHER_URL, so the number of aggregates stays bounded.
+    '''
+    cache_size = 100000
 
-    if errors_limit is not None and total_lines > 0 and error / float(total_lines) > errors_limit:
-        raise RuntimeError('To much errors in log!')
+    def __init__(self, normalization, seen=()):
+        # seen are the keys counted before, e.g. by the previous incremental runs
+        self.normalization = normalization
+        self.cache = {}
+        self.seen = set(seen)
+        self.seen.discard(OTHER_URL)
 
+    def normalize(self, url):
+        normalization = self.normalization
+        path, question, query = url.partition('?')
+        if question and normalization.strip_query:
+            params = [param for param in query.split('&')
+                      if param.partition('=')[0] in normalization.keep_params]
+            url = path + '?' + '&'.join(params) if params else path
+        if normalization.collapse_ids:
+            url = URL_ID_RE.sub(url_id_placeholder, url)
+        return url
 
-def update_statistic_store(store, url, response_time):
+    def __call__(self, url):
+        normalized = self.cache.get(url)
+        if normalized is None:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            normalized = self.cache[url] = self.normalize(url)
+        return self.limit(normalized)
+
+    def limit(self, normalized):
+        max_cardinality = self.normalization.max_cardinality
+        if max_cardinality and normalized not in self.seen:
+            if len(self.seen) >= max_cardinality:
+                return OTHER_URL
+            self.seen.add(normalized)
+        return normalized
+
+
+def worker_normalization(options):
+    '''
+    Splits the url normalization of a parallel aggregation: workers only
+    strip queries and collapse ids, the cardinality is limited by the
+    returned UrlNormalizer while their statistics are merged in the log order.
+    '''
+    normalization = options.normalization
+    if not normalization or not normalization.max_cardinality:
+        return options, None
+    worker = normalization._replace(max_cardinality=None)
+    if not worker.strip_query and not worker.collapse_ids:
+        worker = None
+    return options._replace(normalization=worker), UrlNormalizer(normalization)
+
+
+def limit_statistic(statistic, normalizer):
+    # urls over the cardinality limit are folded into OTHER_URL
+    store = {}
+    for url, rec in statistic.store.items():
+        key = normalizer.limit(url)
+        folded = store.get(key)
+        if folded is None:
+            store[key] = rec
+        else:
+            folded.merge(rec)
+    if statistic.breakdowns is not None and statistic.breakdowns.status is not None:
+        status = {}
+        for url, counters in statistic.breakdowns.status.items():
+            key = normalizer.limit(url)
+            folded = status.get(key)
+            status[key] = counters if folded is None else array('d', map(add, folded, counters))
+        statistic.breakdowns.status = status
+    return statistic._replace(store=store)
+
+
+def normalize_urls(log_lines, normalization, seen=()):
+    # lines are (url, request_time) or the records of the breakdowns
+    normalizer = UrlNormalizer(normalization, seen)
+    for line in log_lines:
+        yield (normalizer(line[0]),) + line[1:]
+
+
+class UrlStatistic(object):
+    '''
+    Aggregate of one url. Request times are kept in a flat array of
+    doubles (exact aggregation) or in a QuantileSketch, derived values
+    like the average are calculated by the report.
+    '''
+    __slots__ = ('count', 'time_sum', 'time_max', 'first_time', 'samples')
+
+    def __init__(self, response_time, samples):
+        self.count = 0
+        # the report time_sum has always counted the first request time twice
+        self.time_sum = response_time
+        self.time_max = response_time
+        self.first_time = response_time
+        self.samples = samples
+
+    def add(self, response_time):
+        self.count += 1
+        self.time_sum += response_time
+        if response_time > self.time_max:
+            self.time_max = response_time
+        self.samples.append(response_time)
+
+    def merge(self, other):
+        # other must hold the lines that follow these ones in the log
+        self.count += other.count
+        self.time_sum += other.time_sum - other.first_time
+        if other.time_max > self.time_max:
+            self.time_max = other.time_max
+        if isinstance(self.samples, QuantileSketch):
+            self.samples.merge(other.samples)
+        else:
+            self.samples.extend(other.samples)
+
+    def time_avg(self):
+        return self.time_sum / self.count
+
+    def quantiles(self, qs):
+        if isinstance(self.samples, QuantileSketch):
+            return self.samples.quantiles(qs)
+        return exact_quantiles(self.samples, qs)
+
+
+REPORT_SORT_KEYS = {
+    'time_sum': lambda rec: rec.time_sum,
+    'time_avg': UrlStatistic.time_avg,
+    'time_max': lambda rec: rec.time_max,
+    'count': lambda rec: rec.count,
+    'p99': lambda rec: rec.quantiles([0.99])[0],
+}
+
+
+class Breakdowns(object):
+    '''
+    Counters of the extra report cuts collected in the same pass as the
+    per-url statistic. status: url -> counts of the 1xx..5xx responses
+    followed by their time sums; hours: start of the hour in the local
+    time of the log, counted in seconds like a UTC timestamp -> count,
+    time sum, time max and the counts of 1xx..5xx. A counter is one flat
+    array.
+    '''
+    __slots__ = ('status', 'hours')
+
+    def __init__(self, dimensions):
+        self.status = {} if 'status' in dimensions else None
+        self.hours = {} if 'hour' in dimensions else None
+
+    def dimensions(self):
+        return tuple(dimension for dimension, counters in zip(BREAKDOWN_DIMENSIONS, (self.status, self.hours))
+                     if counters is not None)
+
+    def add(self, url, request_time, timestamp, status, utc_offset):
+        status_class = status // 100
+        if self.status is not None and 1 <= status_class <= 5:
+            counters = self.status.get(url)
+            if counters is None:
+                counters = self.status[url] = array('d', [0.0]) * 10
+            counters[status_class - 1] += 1
+            counters[status_class + 4] += request_time
+        if self.hours is not None:
+            # hours are the ones of $time_local, not of the host zone
+            local_time = timestamp + utc_offset
+            hour = local_time - local_time % 3600
+            counters = self.hours.get(hour)
+            if counters is None:
+                counters = self.hours[hour] = array('d', [0.0]) * 8
+            counters[0] += 1
+            counters[1] += request_time
+            if request_time > counters[2]:
+                counters[2] = request_time
+            if 1 <= status_class <= 5:
+                counters[status_class + 2] += 1
+
+    def merge(self, other):
+        if self.status is not None and other.status is not None:
+            for url, other_counters in other.status.items():
+                counters = self.status.get(url)
+                self.status[url] = array('d', other_counters if counters is None else map(add, counters, other_counters))
+        if self.hours is not None and other.hours is not None:
+            for hour, other_counters in other.hours.items():
+                counters = self.hours.get(hour)
+                if counters is None:
+                    self.hours[hour] = array('d', other_counters)
+                    continue
+                time_max = max(counters[2], other_counters[2])
+                counters = self.hours[hour] = array('d', map(add, counters, other_counters))
+                counters[2] = time_max
+
+
+def new_samples(options):
+    if options.accuracy is not None:
+        return QuantileSketch(options.accuracy)
+    if options.cache_accuracy is not None:
+        return SketchedSamples(options.cache_accuracy)
+    return array('d')
+
+
+def update_statistic_store(store, url, response_time, options=EXACT_AGGREGATION):
     rec = store.get(url)
-    if not rec:
-        rec = {
-            'url': url,
-            'request_count': 0,
-            'response_time_sum': response_time,
-            'max_response_time': response_time,
-            'avg_responce_time': 0.,
-            'all_responce_time': []
-        }
-        store[url] = rec
+    if rec is None:
+        rec = store[url] = UrlStatistic(response_time, new_samples(options))
+    rec.add(response_time)
 
-    rec['request_count'] += 1
-    rec['response_time_sum'] += response_time
-    rec['max_response_time'] = max(store[url]['max_response_time'], response_time)
-    rec['avg_responce_time'] = rec['response_time_sum'] / rec['request_count']
-    rec['all_responce_time'].append(response_time)
 
+def merge_statistic_store(store, other):
+    for url, other_rec in other.items():
+        rec = store.get(url)
+        if rec is None:
+            store[url] = other_rec
+        else:
+            rec.merge(other_rec)
 
-def cals_statistic(log_lines, config_meta):
+
+def aggregate_records(records, options):
+    # the same as aggregate_statistic over (url, request_time, timestamp, status, utc_offset) records
+    url_count = 0
+    total_req_time = 0.0
+    store = {}
+    breakdowns = Breakdowns(options.breakdowns)
+    add_breakdowns = breakdowns.add
+    for url, request_time, timestamp, status, utc_offset in records:
+        url_count += 1
+        total_req_time += request_time
+        update_statistic_store(store, url, request_time, options)
+        add_breakdowns(url, request_time, timestamp, status, utc_offset)
+    return Statistic(store=store, url_count=url_count, total_req_time=total_req_time, breakdowns=breakdowns)
+
+
+def aggregate_statistic(log_lines, options=EXACT_AGGREGATION):
+    if options.normalization:
+        log_lines = normalize_urls(log_lines, options.normalization)
+    if options.breakdowns:
+        return aggregate_records(log_lines, options)
     url_count = 0
     total_req_time = 0.0
     store = {}
     for url, request_time in log_lines:
         url_count += 1
         total_req_time += request_time
-        update_statistic_store(store, url, request_time)
-    agreggatebyurl = sorted(store.items(), key=lambda item : item[1]['avg_responce_time'], reverse=True)
-    if config_meta.REPORT_SIZE > len(agreggatebyurl):
-        agreggatebyurl = agreggatebyurl[:config_meta.REPORT_SIZE]
+        update_statistic_store(store, url, request_time, options)
+    return Statistic(store=store, url_count=url_count, total_req_time=total_req_time)
+
+
+class NumpyStore(object):
+    '''
+    Per-url aggregates of the numpy engine calculated with grouped array
+    operations. Sums and maximums are accumulated in the log order, so the
+    rows are byte-identical to the ones of the python engine.
+    '''
+    def __init__(self, urls, ids, times):
+        self.urls = urls
+        self.counts = np.bincount(ids, minlength=len(urls))
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+        # request times grouped by url, the stable sort keeps the log order inside a group
+        self.grouped_times = times[np.argsort(ids, kind='stable')]
+        self.firsts = self.grouped_times[self.offsets[:-1]]
+        # the report time_sum has always counted the first request time twice
+        self.sums = self.firsts.copy()
+        np.add.at(self.sums, ids, times)
+        self.maxs = self.firsts.copy()
+        np.maximum.at(self.maxs, ids, times)
+        self.sorted_times = None
+
+    def __len__(self):
+        return len(self.urls)
+
+    def quantile(self, q):
+        if self.sorted_times is None:
+            grouped_ids = np.repeat(np.arange(len(self.urls)), self.counts)
+            self.sorted_times = self.grouped_times[np.lexsort((self.grouped_times, grouped_ids))]
+        rank = q * (self.counts - 1)
+        low = rank.astype(np.int64)
+        high = np.minimum(low + 1, self.counts - 1)
+        base = self.offsets[:-1]
+        low_times = self.sorted_times[base + low]
+        return low_times + (self.sorted_times[base + high] - low_times) * (rank - low)
+
+    def sort_key(self, sort_key):
+        if sort_key == 'time_sum':
+            return self.sums
+        if sort_key == 'time_avg':
+            return self.sums / self.counts
+        if sort_key == 'time_max':
+            return self.maxs
+        if sort_key == 'count':
+            return self.counts
+        if sort_key == 'p99':
+            return self.quantile(0.99)
+        raise ValueError('Unknown report sort key: {}'.format(sort_key))
+
+    def url_statistic(self, url_id):
+        start, end = self.offsets[url_id], self.offsets[url_id + 1]
+        rec = UrlStatistic(float(self.firsts[url_id]), array('d', self.grouped_times[start:end].tolist()))
+        rec.count = int(self.counts[url_id])
+        rec.time_sum = float(self.sums[url_id])
+        rec.time_max = float(self.maxs[url_id])
+        return rec
+
+    def items(self):
+        for url_id, url in enumerate(self.urls):
+            yield url, self.url_statistic(url_id)
+
+    def select_top_urls(self, size, sort_key):
+        # a stable sort of the negated key keeps ties in the log order like heapq.nlargest does
+        top = np.argsort(-self.sort_key(sort_key), kind='stable')[:size]
+        return [(self.urls[url_id], self.url_statistic(url_id)) for url_id in top.tolist()]
+
+
+def aggregate_numpy(log_lines, options=EXACT_AGGREGATION, batch_size=NUMPY_BATCH_SIZE):
+    if np is None:
+        raise RuntimeError('numpy engine requires numpy to be installed')
+    if options.accuracy is not None:
+        raise ValueError('numpy engine supports only the exact aggregation')
+    if options.breakdowns:
+        raise ValueError('numpy engine does not support the breakdowns')
+    if options.normalization:
+        log_lines = normalize_urls(log_lines, options.normalization)
+
+    # a new url gets the next id on the first lookup, so the ids keep the log order
+    url_ids = defaultdict()
+    url_ids.default_factory = url_ids.__len__
+    id_batches = [np.empty(0, dtype=np.int64)]
+    time_batches = [np.empty(0, dtype=np.float64)]
+    log_lines = iter(log_lines)
+    while True:
+        batch = list(itertools.islice(log_lines, batch_size))
+        if not batch:
+            break
+        id_batches.append(np.fromiter(map(url_ids.__getitem__, map(itemgetter(0), batch)),
+                                      dtype=np.int64, count=len(batch)))
+        time_batches.append(np.fromiter(map(itemgetter(1), batch), dtype=np.float64, count=len(batch)))
+
+    ids = np.concatenate(id_batches)
+    times = np.concatenate(time_batches)
+    # cumsum adds in the log order, like the python engine does
+    total_req_time = float(np.cumsum(times)[-1]) if len(times) else 0.0
+    store = NumpyStore(list(url_ids), ids, times)
+    return Statistic(store=store, url_count=len(times), total_req_time=total_req_time)
 
-    #
+
+AGGREGATION_ENGINES = {
+    'python': aggregate_statistic,
+    'numpy': aggregate_numpy,
+}
+
+
+def get_engine(config):
+    engine = getattr(config, 'ENGINE', 'python')
+    try:
+        return AGGREGATION_ENGINES[engine]
+    except KeyError:
+        raise ValueError('Unknown aggregation engine: {}'.format(engine))
+
+
+class SpilledStore(object):
+    '''
+    Per-url aggregates that did not fit into the memory budget. Every time
+    the store grows over it, it is split by a stable hash of the url into
+    partition files and cleared. The report merges one partition at a time
+    and keeps only its top urls; a partition whose parts add up to more
+    than the budget is split again before it is merged. Records remember
+    the position of the first request of their url, so ties are ordered
+    like in a dict store.
+    '''
+    order_bits = 40
+
+    def __init__(self, partitions=16, spill_dir=None, sketch=False, max_bytes=None):
+        self.partitions = partitions
+        self.sketch = sketch
+        self.max_bytes = max_bytes
+        self.url_bytes = STORE_URL_BYTES['sketch' if sketch else 'exact']
+        self.sample_bytes = 0 if sketch else 8
+        self.path = tempfile.mkdtemp(prefix='log_analyzer-', dir=spill_dir)
+        self.spills = 0
+        # estimated size of every partition in memory, the sum of its parts
+        self.partition_bytes = [0] * partitions
+        self.merge_paths = None
+        self.distinct_urls = None
+        self.finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+
+    def partition_path(self, partition):
+        return os.path.join(self.path, 'partition-{}.pickle'.format(partition))
+
+    def new_part(self):
+        # a part is pickled as columns, it is much faster than pickling every record;
+        # exact samples of all urls are concatenated into one array
+        return ([], array('q'), array('q'), array('d'), array('d'), array('d'), array('q'),
+                [] if self.sketch else array('d'))
+
+    def add_record(self, part, url, order, rec):
+        urls, orders, counts, time_sums, time_maxs, first_times, sample_counts, samples = part
+        urls.append(url)
+        orders.append(order)
+        counts.append(rec.count)
+        time_sums.append(rec.time_sum)
+        time_maxs.append(rec.time_max)
+        first_times.append(rec.first_time)
+        if self.sketch:
+            samples.append(rec.samples)
+        else:
+            sample_counts.append(len(rec.samples))
+            samples.extend(rec.samples)
+
+    def write_part(self, path, part):
+        # returns the estimated size of the part in memory
+        with open(path, 'ab') as part_file:
+            pickle.dump(part, part_file, protocol=pickle.HIGHEST_PROTOCOL)
+        return len(part[0]) * self.url_bytes + len(part[-1]) * self.sample_bytes
+
+    def spill(self, store):
+        parts = [self.new_part() for _ in range(self.partitions)]
+        order = self.spills << self.order_bits
+        for position, (url, rec) in enumerate(store.items()):
+            self.add_record(parts[zlib.crc32(url.encode('utf-8')) % self.partitions], url, order + position, rec)
+        for partition, part in enumerate(parts):
+            if part[0]:
+                self.partition_bytes[partition] += self.write_part(self.partition_path(partition), part)
+        self.spills += 1
+        store.clear()
+
+    def read_part(self, part):
+        urls, orders, counts, time_sums, time_maxs, first_times, sample_counts, samples = part
+        if self.sketch:
+            url_samples = samples
+        else:
+            offsets = list(itertools.accumulate(sample_counts, initial=0))
+            url_samples = (samples[start:end] for start, end in zip(offsets, offsets[1:]))
+        for url, order, count, time_sum, time_max, first_time, rec_samples in \
+                zip(urls, orders, counts, time_sums, time_maxs, first_times, url_samples):
+            rec = UrlStatistic(first_time, rec_samples)
+            rec.count, rec.time_sum, rec.time_max = count, time_sum, time_max
+            yield url, order, rec
+
+    def read_parts(self, path):
+        # yields the records of one part at a time
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as part_file:
+            while True:
+                try:
+                    part = pickle.load(part_file)
+                except EOFError:
+                    break
+                yield self.read_part(part)
+
+    def split_partition(self, partition):
+        # the number of splits is the estimated size of the partition divided by the budget
+        path = self.partition_path(partition)
+        splits = 1
+        if self.max_bytes:
+            splits = min(SPILL_MAX_SPLITS, -(-self.partition_bytes[partition] // self.max_bytes))
+        if splits <= 1:
+            return [path]
+        split_paths = ['{}.{}'.format(path, split) for split in range(splits)]
+        for records in self.read_parts(path):
+            split_parts = [self.new_part() for _ in range(splits)]
+            for url, order, rec in records:
+                self.add_record(split_parts[zlib.crc32(url.encode('utf-8')) // self.partitions % splits],
+                                url, order, rec)
+            for split_path, part in zip(split_paths, split_parts):
+                if part[0]:
+                    self.write_part(split_path, part)
+        os.remove(path)
+        return split_paths
+
+    def merge_files(self):
+        if self.merge_paths is None:
+            self.merge_paths = [split_path for partition in range(self.partitions)
+                                for split_path in self.split_partition(partition)]
+        return self.merge_paths
+
+    def load_partition(self, path):
+        # the parts are merged in the order they were spilled, i.e. in the log order
+        merged = {}
+        for records in self.read_parts(path):
+            for url, order, rec in records:
+                first = merged.get(url)
+                if first is None:
+                    merged[url] = (order, rec)
+                else:
+                    first[1].merge(rec)
+        return merged
+
+    def __len__(self):
+        if self.distinct_urls is None:
+            self.distinct_urls = sum(len(self.load_partition(path)) for path in self.merge_files())
+        return self.distinct_urls
+
+    def items(self):
+        for path in self.merge_files():
+            yield from ((url, rec) for url, (_, rec) in self.load_partition(path).items())
+
+    def partition_top(self, path, size, item_key):
+        # no reference to a merged partition outlives the call, only one is in memory at a time
+        merged = self.load_partition(path)
+        return len(merged), heapq.nlargest(size, merged.items(), key=item_key)
+
+    def select_top_urls(self, size, sort_key):
+        try:
+            key = REPORT_SORT_KEYS[sort_key]
+        except KeyError:
+            raise ValueError('Unknown report sort key: {}'.format(sort_key))
+
+        def item_key(item):
+            order, rec = item[1]
+            return key(rec), -order
+
+        # distinct urls are counted while the partitions are merged for the report
+        distinct_urls = 0
+        candidates = []
+        for path in self.merge_files():
+            urls, top = self.partition_top(path, size, item_key)
+            distinct_urls += urls
+            candidates.extend(top)
+        self.distinct_urls = distinct_urls
+        return [(url, rec) for url, (_, rec) in heapq.nlargest(size, candidates, key=item_key)]
+
+
+def aggregate_spilling(log_lines, options=EXACT_AGGREGATION, max_bytes=512 * 1024 * 1024, partitions=16,
+                       spill_dir=None):
+    # aggregate_statistic with the store spilled to disk when its estimated size exceeds max_bytes
+    if options.breakdowns:
+        raise ValueError('The breakdowns are not supported with a memory budget')
+    if options.normalization:
+        log_lines = normalize_urls(log_lines, options.normalization)
+    url_bytes = STORE_URL_BYTES['exact' if options.accuracy is None else 'sketch']
+    sample_bytes = 8 if options.accuracy is None else 0
+    spilled = None
+    url_count = 0
+    total_req_time = 0.0
+    store = {}
+    stored_lines = 0
+    for url, request_time in log_lines:
+        url_count += 1
+        total_req_time += request_time
+        update_statistic_store(store, url, request_time, options)
+        stored_lines += 1
+        if stored_lines % SPILL_CHECK_INTERVAL == 0 and \
+                len(store) * url_bytes + stored_lines * sample_bytes > max_bytes:
+            if spilled is None:
+                spilled = SpilledStore(partitions, spill_dir, sketch=options.accuracy is not None, max_bytes=max_bytes)
+            spilled.spill(store)
+            stored_lines = 0
+    if spilled is not None:
+        spilled.spill(store)
+        store = spilled
+    return Statistic(store=store, url_count=url_count, total_req_time=total_req_time)
+
+
+def merge_statistic(statistics, normalizer=None):
+    # normalizer limits the url cardinality of the statistics that are merged in the log order
+    store = {}
+    url_count = 0
+    total_req_time = 0.0
+    error_count = 0
+    breakdowns = None
+    for statistic in statistics:
+        if normalizer is not None:
+            statistic = limit_statistic(statistic, normalizer)
+        merge_statistic_store(store, statistic.store)
+        url_count += statistic.url_count
+        total_req_time += statistic.total_req_time
+        error_count += statistic.error_count
+        if statistic.breakdowns is not None:
+            if breakdowns is None:
+                breakdowns = Breakdowns(statistic.breakdowns.dimensions())
+            breakdowns.merge(statistic.breakdowns)
+    return Statistic(store=store, url_count=url_count, total_req_time=total_req_time, error_count=error_count,
+                     breakdowns=breakdowns)
+
+
+def split_log(path, parts):
+    bounds = [0]
+    with map_log(path) as mapped:
+        size = len(mapped) if mapped is not None else 0
+        for part in range(1, parts):
+            offset = max(size * part // parts, bounds[-1], 1)
+            if offset >= size:
+                break
+            # a range starts right after the first newline at or after offset - 1
+            newline = mapped.find(b'\n', offset - 1)
+            bounds.append(newline + 1 if newline >= 0 else size)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def aggregate_log_range(log_meta, parser, start, end, options=EXACT_AGGREGATION, errors_limit=None,
+                        warmup_lines=10000):
+    metrics = {}
+    statistic = aggregate_statistic(xreadlines(log_meta, None, parser=parser, start=start, end=end,
+                                               errors_limit=errors_limit, warmup_lines=warmup_lines,
+                                               metrics=metrics), options)
+    return statistic._replace(error_count=metrics['errors'])
+
+
+def aggregate_log_parallel(log_meta, parser, workers, options=EXACT_AGGREGATION, errors_limit=None,
+                           warmup_lines=10000):
+    # every range checks the errors budget on its own
+    ranges = split_log(log_meta.path, workers)
+    options, normalizer = worker_normalization(options)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(aggregate_log_range, log_meta, parser, start, end, options, errors_limit,
+                                   warmup_lines)
+                   for start, end in ranges]
+        return merge_statistic((future.result() for future in futures), normalizer)
+
+
+def parse_chunk(chunk, parser, metrics):
+    parser = get_parser(parser)
+    decode = not getattr(parser, 'accepts_bytes', False)
+    lines = split_chunk(chunk)
+    errors = 0
+    for line in lines:
+        parsed_line = parser(line.decode('utf-8') if decode else line)
+        if parsed_line:
+            yield parsed_line
+        else:
+            errors += 1
+    metrics.update(total_lines=len(lines), processed=len(lines) - errors, errors=errors)
+
+
+def aggregate_chunk(chunk, parser, options=EXACT_AGGREGATION):
+    metrics = {}
+    statistic = aggregate_statistic(parse_chunk(chunk, parser, metrics), options)
+    return statistic._replace(error_count=metrics['errors'])
+
+
+def iter_chunk_statistics(executor, chunks, parser, max_pending, options=EXACT_AGGREGATION, errors_limit=None,
+                          warmup_lines=10000):
+    pending = deque()
+    total_lines = 0
+    errors = 0
+
+    def collect():
+        nonlocal total_lines, errors
+        statistic = pending.popleft().result()
+        total_lines += statistic.url_count + statistic.error_count
+        errors += statistic.error_count
+        if total_lines >= warmup_lines:
+            check_errors(total_lines, errors, errors_limit)
+        return statistic
+
+    for chunk in chunks:
+        pending.append(executor.submit(aggregate_chunk, chunk, parser, options))
+        if len(pending) >= max_pending:
+            yield collect()
+    while pending:
+        yield collect()
+    check_errors(total_lines, errors, errors_limit)
+
+
+def aggregate_gzip_parallel(log_meta, parser, workers, block_size, queue_size, options=EXACT_AGGREGATION,
+                            errors_limit=None, warmup_lines=10000):
+    # one thread inflates the log, chunks of lines are aggregated by worker processes
+    # and merged in the log order, the number of chunks in flight is bounded
+    chunks = iter_in_thread(read_gzip_blocks(log_meta.path, block_size), queue_size)
+    options, normalizer = worker_normalization(options)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return merge_statistic(iter_chunk_statistics(executor, chunks, parser, workers * 2, options,
+                                                     errors_limit, warmup_lines), normalizer)
+
+
+def cals_statistic(log_lines, config_meta):
+    aggregate = get_engine(config_meta)
+    yield from report_statistic(aggregate(log_lines, aggregate_options(config_meta)), config_meta)
+
+
+def percentile_column(percentile):
+    return 'time_p' + '{:g}'.format(percentile).replace('.', '')
+
+
+def select_top_urls(store, size, sort_key):
+    try:
+        key = REPORT_SORT_KEYS[sort_key]
+    except KeyError:
+        raise ValueError('Unknown report sort key: {}'.format(sort_key))
+    # the same order as sorted(..., reverse=True)[:size], ties keep the log order
+    return heapq.nlargest(size, store.items(), key=lambda item: key(item[1]))
+
+
+def status_report(statistic, config_meta):
+    # urls with the most 4xx and 5xx responses
+    top = heapq.nlargest(config_meta.REPORT_SIZE, statistic.breakdowns.status.items(),
+                         key=lambda item: (item[1][3] + item[1][4], sum(item[1][:5])))
+    for url, counters in top:
+        count = sum(counters[:5])
+        row = {
+            'url': url,
+            'count': int(count),
+            'errors_perc': round((counters[3] + counters[4]) / count * 100.0, 5),
+        }
+        for status_class in STATUS_CLASSES:
+            class_count = counters[status_class - 1]
+            row['count_{}xx'.format(status_class)] = int(class_count)
+            row['time_avg_{}xx'.format(status_class)] = \
+                round(counters[status_class + 4] / class_count, 5) if class_count else 0.0
+        yield row
+
+
+def hours_report(statistic):
+    for hour in sorted(statistic.breakdowns.hours):
+        count, time_sum, time_max, *class_counts = statistic.breakdowns.hours[hour]
+        row = {
+            'hour': datetime.fromtimestamp(hour, timezone.utc).strftime('%Y-%m-%d %H:00'),
+            'count': int(count),
+            'count_perc': round(count / statistic.url_count * 100.0, 5),
+            'time_sum': round(time_sum, 5),
+            'time_avg': round(time_sum / count, 5),
+            'time_max': round(time_max, 5),
+        }
+        for status_class, class_count in zip(STATUS_CLASSES, class_counts):
+            row['count_{}xx'.format(status_class)] = int(class_count)
+        yield row
+
+
+def report_statistic(statistic, config_meta):
+    store, url_count, total_req_time = statistic.store, statistic.url_count, statistic.total_req_time
+    percentiles = getattr(config_meta, 'PERCENTILES', [])
+    qs = [0.5] + [percentile / 100.0 for percentile in percentiles]
+    sort_key = getattr(config_meta, 'REPORT_SORT_KEY', 'time_avg')
+    if isinstance(store, (NumpyStore, SpilledStore)):
+        agreggatebyurl = store.select_top_urls(config_meta.REPORT_SIZE, sort_key)
+    else:
+        agreggatebyurl = select_top_urls(store, config_meta.REPORT_SIZE, sort_key)
+
+    # medians and percentiles are calculated only for the urls in the report
     for url, val in agreggatebyurl:
-        yield  {
+        samples = val.samples
+        if isinstance(samples, QuantileSketch):
+            time_med, *time_percentiles = samples.quantiles(qs)
+        else:
+            time_med = median(samples)
+            time_percentiles = exact_quantiles(samples, qs[1:]) if percentiles else []
+        row = {
                 'url': url,
-                'count': val['request_count'],
-                'count_perc': round((val['request_count'] / url_count) * 100.0, 5) ,
-                'time_sum': round(val['response_time_sum'], 5),
-                'time_med': round(median(val['all_responce_time']), 5),
-                'time_perc': round((val['response_time_sum'] / total_req_time) * 100.0, 5),
-                'time_max': round(val['max_response_time'], 5),
-                'time_avg': round(val['response_time_sum'] / val['request_count'], 5)
+                'count': val.count,
+                'count_perc': round((val.count / url_count) * 100.0, 5) ,
+                'time_sum': round(val.time_sum, 5),
+                'time_med': round(time_med, 5),
+                'time_perc': round((val.time_sum / total_req_time) * 100.0, 5),
+                'time_max': round(val.time_max, 5),
+                'time_avg': round(val.time_avg(), 5)
         }
+        for percentile, value in zip(percentiles, time_percentiles):
+            row[percentile_column(percentile)] = round(value, 5)
+        yield row
+
+
+def file_identity(path):
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino
+
+
+def last_line_end(path, start, size):
+    # the writer may be in the middle of a line, only complete lines are aggregated
+    if size <= start:
+        return start
+    with map_log(path) as mapped:
+        newline = mapped.rfind(b'\n', start, size) if mapped is not None else -1
+    return newline + 1 if newline >= 0 else start
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as checkpoint_file:
+        return pickle.load(checkpoint_file)
+
+
+def save_checkpoint(path, checkpoint):
+    checkpoint_dir = os.path.dirname(path)
+    if checkpoint_dir and not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    with open(path + '.tmp', 'wb') as checkpoint_file:
+        pickle.dump(checkpoint, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def update_checkpoint(checkpoint, log_meta, parser, options=EXACT_AGGREGATION):
+    identity = file_identity(log_meta.path)
+    size = os.path.getsize(log_meta.path)
+    if checkpoint is None or checkpoint.identity != identity or checkpoint.offset > size \
+            or checkpoint.options != options:
+        # the log was rotated or the aggregation changed, start from scratch
+        checkpoint = Checkpoint(identity=identity, offset=0, options=options,
+                                statistic=Statistic(store={}, url_count=0, total_req_time=0.0))
+
+    end = last_line_end(log_meta.path, checkpoint.offset, size)
+    if end == checkpoint.offset:
+        return checkpoint
+    log_lines = xreadlines(log_meta, None, parser=parser, start=checkpoint.offset, end=end)
+    if options.normalization:
+        # URL_MAX_CARDINALITY bounds the whole log, not every run
+        log_lines = normalize_urls(log_lines, options.normalization, checkpoint.statistic.store)
+        options = options._replace(normalization=None)
+    statistic = aggregate_statistic(log_lines, options)
+    return checkpoint._replace(offset=end, statistic=merge_statistic([checkpoint.statistic, statistic]))
+
+
+def sketch_statistic(statistic, accuracy):
+    # exact samples are folded into sketches, so aggregates of many days stay small and mergeable;
+    # samples sketched during the aggregation are not read again
+    store = {}
+    for url, rec in statistic.store.items():
+        if isinstance(rec.samples, SketchedSamples):
+            sketched = UrlStatistic(rec.first_time, rec.samples.sketch)
+            sketched.count, sketched.time_sum, sketched.time_max = rec.count, rec.time_sum, rec.time_max
+            rec = sketched
+        elif not isinstance(rec.samples, QuantileSketch):
+            sketch = QuantileSketch(accuracy)
+            for response_time in rec.samples:
+                sketch.append(response_time)
+            sketched = UrlStatistic(rec.first_time, sketch)
+            sketched.count, sketched.time_sum, sketched.time_max = rec.count, rec.time_sum, rec.time_max
+            rec = sketched
+        store[url] = rec
+    return statistic._replace(store=store)
+
+
+def day_cache_path(config, date):
+    cache_dir = getattr(config, 'CACHE_DIR', None)
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, 'aggregate-{}.pickle.gz'.format(date))
+
+
+def save_day_cache(path, statistic):
+    cache_dir = os.path.dirname(path)
+    if cache_dir:
+        # backfill processes create the directory concurrently
+        os.makedirs(cache_dir, exist_ok=True)
+    with gzip.open(path + '.tmp', 'wb') as cache_file:
+        pickle.dump(statistic, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def load_day_cache(path):
+    with gzip.open(path, 'rb') as cache_file:
+        return pickle.load(cache_file)
+
+
+def parse_date_range(date_range):
+    first, _, last = date_range.partition('..')
+    first = datetime.strptime(first, '%Y%m%d')
+    last = datetime.strptime(last or first.strftime('%Y%m%d'), '%Y%m%d')
+    if last < first:
+        raise ValueError('Wrong date range: {}'.format(date_range))
+    return [(first + timedelta(days=day)).strftime('%Y%m%d') for day in range((last - first).days + 1)]
+
+
+def generate_range_report_name(first_date, last_date):
+    return 'report-{}.{}.{}-{}.{}.{}.html'.format(first_date[:4], first_date[4:6], first_date[6:],
+                                                    last_date[:4], last_date[4:6], last_date[6:])
+
+
+def find_log_by_date(config, date):
+    log = scan_logs(config.LOG_DIR, log_name_re(config)).get(date)
+    if not log:
+        return None
+    file_name, expansion = log
+    return LogMeta(path=os.path.join(config.LOG_DIR, file_name), date=date, expansion=expansion)
 
 
-def generate_report(statistic, config, log_meta, template_path):
+Columns = namedtuple('Columns', ['urls', 'url_id', 'request_time', 'timestamp', 'status', 'utc_offset', 'meta'])
+
+
+def columns_path(config, date):
+    return os.path.join(getattr(config, 'COLUMNS_DIR', './columns'), date)
+
+
+def columns_report_name(date):
+    return COLUMNS_REPORT_NAME.format(date[:4], date[4:6], date[6:])
+
+
+def export_columns(log_meta, config, path):
+    '''
+    Saves the parsed records of a log as raw columns, one file per field,
+    urls are replaced by their ids in the order of the first appearance
+    and listed in meta.json. The directory appears only when it is complete.
+    '''
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    url_ids = defaultdict()
+    url_ids.default_factory = url_ids.__len__
+    metrics = {}
+    records = xreadlines(log_meta, None, parser=record_parser(config),
+                         errors_limit=getattr(config, 'ERRORS_LIMIT', None),
+                         warmup_lines=getattr(config, 'ERRORS_WARMUP_LINES', 10000), metrics=metrics)
+    column_files = [open(os.path.join(tmp_path, name + '.bin'), 'wb') for name, _ in COLUMN_TYPES]
+    try:
+        while True:
+            batch = list(itertools.islice(records, COLUMNS_BATCH_SIZE))
+            if not batch:
+                break
+            urls, *values = zip(*batch)
+            array('I', map(url_ids.__getitem__, urls)).tofile(column_files[0])
+            for (_, typecode), column, column_file in zip(COLUMN_TYPES[1:], values, column_files[1:]):
+                array(typecode, column).tofile(column_file)
+    finally:
+        for column_file in column_files:
+            column_file.close()
+    meta = {
+        'log': log_meta.path,
+        'date': log_meta.date,
+        'rows': metrics['processed'],
+        'errors': metrics['errors'],
+        'byteorder': sys.byteorder,
+        'columns': {name: {'typecode': typecode, 'itemsize': array(typecode).itemsize}
+                    for name, typecode in COLUMN_TYPES},
+        'urls': list(url_ids),
+    }
+    with open(os.path.join(tmp_path, COLUMNS_META_NAME), 'w', encoding='utf-8') as meta_file:
+        json.dump(meta, meta_file, ensure_ascii=False)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def columns_complete(path):
+    # columns saved before a column was added are parsed again
+    try:
+        with open(os.path.join(path, COLUMNS_META_NAME), encoding='utf-8') as meta_file:
+            saved = json.load(meta_file)['columns']
+    except FileNotFoundError:
+        return False
+    return all(name in saved for name, _ in COLUMN_TYPES)
+
+
+def load_columns(path):
+    # columns are memory-mapped numpy arrays when numpy is installed, arrays otherwise
+    with open(os.path.join(path, COLUMNS_META_NAME), encoding='utf-8') as meta_file:
+        meta = json.load(meta_file)
+    if meta['byteorder'] != sys.byteorder:
+        raise ValueError('Columns in {} are written with {} byte order'.format(path, meta['byteorder']))
+    columns = {}
+    for name, typecode in COLUMN_TYPES:
+        if name not in meta['columns']:
+            raise ValueError('Column {} is missing in {}'.format(name, path))
+        column_path = os.path.join(path, name + '.bin')
+        if array(typecode).itemsize != meta['columns'][name]['itemsize']:
+            raise ValueError('Column {} in {} has another item size'.format(name, path))
+        if np is not None:
+            dtype = np.dtype(typecode)
+            columns[name] = np.memmap(column_path, dtype=dtype, mode='r') if meta['rows'] else np.empty(0, dtype)
+        else:
+            columns[name] = array(typecode)
+            with open(column_path, 'rb') as column_file:
+                columns[name].fromfile(column_file, meta['rows'])
+    return Columns(urls=meta['urls'], meta=meta, **columns)
+
+
+def aggregate_columns(columns, config, url_filter=None):
+    # url_filter is a compiled regex searched in the urls
+    urls, url_ids, times = columns.urls, columns.url_id, columns.request_time
+    options = aggregate_options(config)
+    if np is not None and isinstance(url_ids, np.ndarray) and options == EXACT_AGGREGATION:
+        if url_filter:
+            keep = np.fromiter((url_filter.search(url) is not None for url in urls), dtype=bool, count=len(urls))
+            rows = keep[url_ids]
+            # the kept urls get new ids in the same order
+            url_ids = (np.cumsum(keep) - 1)[url_ids[rows]]
+            times = times[rows]
+            urls = [url for url, kept in zip(urls, keep.tolist()) if kept]
+        total_req_time = float(np.cumsum(times)[-1]) if len(times) else 0.0
+        return Statistic(store=NumpyStore(urls, url_ids, np.asarray(times)), url_count=len(times),
+                         total_req_time=total_req_time, error_count=columns.meta['errors'])
+
+    if np is not None and isinstance(url_ids, np.ndarray):
+        url_ids, times = url_ids.tolist(), times.tolist()
+    if options.breakdowns:
+        timestamps, statuses, utc_offsets = columns.timestamp, columns.status, columns.utc_offset
+        if np is not None and isinstance(timestamps, np.ndarray):
+            timestamps, statuses, utc_offsets = timestamps.tolist(), statuses.tolist(), utc_offsets.tolist()
+        log_lines = ((urls[url_id], request_time, timestamp, status, utc_offset)
+                     for url_id, request_time, timestamp, status, utc_offset
+                     in zip(url_ids, times, timestamps, statuses, utc_offsets))
+    else:
+        log_lines = ((urls[url_id], request_time) for url_id, request_time in zip(url_ids, times))
+    if url_filter:
+        log_lines = (line for line in log_lines if url_filter.search(line[0]))
+    statistic = get_engine(config)(log_lines, options)
+    return statistic._replace(error_count=columns.meta['errors'])
+
+
+REPORT_TABLE_PLACEHOLDER = '{table_json}'
+
+ROW_ENCODER = json.JSONEncoder(ensure_ascii=False)
+
+# the shell of a report with a data file loads the rows before the table is drawn
+REPORT_DATA_LOADER = '$.ajax({{url: {}, async: false, dataType: "json"}}).responseJSON'
+
+# template path -> (inode, mtime, size, (prefix, suffix))
+TEMPLATE_CACHE = {}
+
+
+def load_template(template_path):
+    # the template is split once and reused until the file changes
+    stat = os.stat(template_path)
+    cached = TEMPLATE_CACHE.get(template_path)
+    if cached and cached[:3] == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+        return cached[3]
     with open(template_path, 'rb') as tf:
         template_file = tf.read().decode('utf-8')
+    prefix, placeholder, suffix = template_file.partition(REPORT_TABLE_PLACEHOLDER)
+    if not placeholder:
+        raise ValueError('No {} in the report template {}'.format(REPORT_TABLE_PLACEHOLDER, template_path))
+    TEMPLATE_CACHE[template_path] = (stat.st_ino, stat.st_mtime_ns, stat.st_size, (prefix, suffix))
+    return TEMPLATE_CACHE[template_path][3]
 
-    result = template_file.replace("{", "{{").replace("}", "}}").replace("{table_json}", "table_json").\
-                                                                format(table_json=list(statistic))
-    report_name = generate_report_name(log_meta)
 
-    if not os.path.exists(config.REPORT_DIR):
-        os.makedirs(config.REPORT_DIR)
+def write_table_json(statistic, fw):
+    # rows are written one by one, '</' is escaped so an url can not close the script tag
+    fw.write('[')
+    for number, row in enumerate(statistic):
+        if number:
+            fw.write(', ')
+        fw.write(ROW_ENCODER.encode(row).replace('</', '<\\/'))
+    fw.write(']')
 
-    with open(os.path.join(config.REPORT_DIR, report_name), 'wb') as fw:
-        result = result.encode('utf-8')
-        fw.write(result)
+
+def write_report_file(path, write):
+    # the file appears only when it is complete, check_current_report_done relies on it
+    try:
+        with open(path + '.tmp', 'w', encoding='utf-8') as fw:
+            write(fw)
+    except BaseException:
+        os.remove(path + '.tmp')
+        raise
+    os.replace(path + '.tmp', path)
+
+
+def write_report_shell(report_path, shell):
+    # the shell does not change between refreshes, it is written only when it differs
+    try:
+        with open(report_path, encoding='utf-8') as report:
+            if report.read() == shell:
+                return
+    except FileNotFoundError:
+        pass
+    write_report_file(report_path, lambda fw: fw.write(shell))
+
+
+def generate_report(statistic, config, log_meta, template_path, report_name=None):
+    # with REPORT_DATA_FILE the rows go to report-*.json and the html is a static shell loading it
+    prefix, suffix = load_template(template_path)
+    report_name = report_name or generate_report_name(log_meta)
+
+    os.makedirs(config.REPORT_DIR, exist_ok=True)
+
+    report_path = os.path.join(config.REPORT_DIR, report_name)
+    if not getattr(config, 'REPORT_DATA_FILE', False):
+        def write_report(fw):
+            fw.write(prefix)
+            write_table_json(statistic, fw)
+            fw.write(suffix)
+        write_report_file(report_path, write_report)
+        return
+
+    data_name = os.path.splitext(report_name)[0] + '.json'
+    write_report_file(os.path.join(config.REPORT_DIR, data_name), lambda fw: write_table_json(statistic, fw))
+    write_report_shell(report_path, prefix + REPORT_DATA_LOADER.format(json.dumps(data_name)) + suffix)
+
+
+def follow_log(path, poll_interval=1.0):
+    '''
+    Tails the log like tail -F: yields lists of the complete lines appended
+    since the previous step, an empty list after waiting poll_interval for
+    new ones. Reading starts at the end of the log. A rotated log is read to
+    the end before the new one is opened, a truncated log is read again.
+    '''
+    log = None
+    identity = None
+    tail = b''
+    at_end = True
+    try:
+        while True:
+            if log is None:
+                try:
+                    log = open(path, 'rb')
+                except FileNotFoundError:
+                    yield []
+                    time.sleep(poll_interval)
+                    continue
+                stat = os.fstat(log.fileno())
+                identity = stat.st_dev, stat.st_ino
+                if at_end:
+                    log.seek(0, os.SEEK_END)
+                    at_end = False
+            chunk = log.read(FOLLOW_READ_SIZE)
+            if chunk:
+                chunk = tail + chunk
+                cut = chunk.rfind(b'\n') + 1
+                tail = chunk[cut:]
+                yield split_chunk(chunk[:cut]) if cut else []
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            if stat is not None and ((stat.st_dev, stat.st_ino) != identity or stat.st_size < log.tell()):
+                log.close()
+                log = None
+                tail = b''
+                continue
+            yield []
+            time.sleep(poll_interval)
+    finally:
+        if log is not None:
+            log.close()
+
+
+class WindowBucket(object):
+    __slots__ = ('index', 'store', 'url_count', 'total_req_time', 'error_count')
+
+    def __init__(self, index):
+        self.index = index
+        self.store = {}
+        self.url_count = 0
+        self.total_req_time = 0.0
+        self.error_count = 0
+
+
+class SlidingWindows(object):
+    '''
+    Per-url statistic of the last minutes of a live log. Lines are
+    aggregated into a ring of buckets of bucket_seconds each, a window
+    is merged from its buckets only when it is reported, so a window
+    covers its span rounded up to whole buckets.
+    '''
+
+    def __init__(self, windows, bucket_seconds=10, options=EXACT_AGGREGATION):
+        self.windows = sorted(windows)
+        self.bucket_seconds = bucket_seconds
+        self.options = options
+        self.normalizer = UrlNormalizer(options.normalization) if options.normalization else None
+        self.ring = [None] * self.bucket_count(self.windows[-1])
+
+    def bucket_count(self, seconds):
+        return -(-seconds // self.bucket_seconds)
+
+    def add_lines(self, parsed_lines, now):
+        index = int(now // self.bucket_seconds)
+        slot = index % len(self.ring)
+        bucket = self.ring[slot]
+        if bucket is None or bucket.index != index:
+            bucket = self.ring[slot] = WindowBucket(index)
+            if self.normalizer:
+                self.forget_urls(index)
+        store, options, normalizer = bucket.store, self.options, self.normalizer
+        for parsed_line in parsed_lines:
+            if not parsed_line:
+                bucket.error_count += 1
+                continue
+            url, request_time = parsed_line[0], parsed_line[1]
+            if normalizer:
+                url = normalizer(url)
+            bucket.url_count += 1
+            bucket.total_req_time += request_time
+            update_statistic_store(store, url, request_time, options)
+
+    def forget_urls(self, index):
+        # URL_MAX_CARDINALITY counts only the urls still in the ring, so new urls are not
+        # reported as OTHER_URL after the old ones have left every window
+        seen = set()
+        for bucket in self.ring:
+            if bucket is not None and bucket.index > index - len(self.ring):
+                seen.update(bucket.store)
+        seen.discard(OTHER_URL)
+        self.normalizer.seen = seen
+
+    def statistic(self, seconds, now):
+        last = int(now // self.bucket_seconds)
+        first = last - self.bucket_count(seconds) + 1
+        buckets = sorted((bucket for bucket in self.ring if bucket is not None and first <= bucket.index <= last),
+                         key=attrgetter('index'))
+        # the buckets keep aggregating, so the window gets its own copies of the records
+        store = {}
+        for bucket in buckets:
+            for url, rec in bucket.store.items():
+                merged = store.get(url)
+                if merged is None:
+                    merged = store[url] = UrlStatistic(rec.first_time, new_samples(self.options))
+                merged.merge(rec)
+        return Statistic(store=store, url_count=sum(bucket.url_count for bucket in buckets),
+                         total_req_time=sum(bucket.total_req_time for bucket in buckets),
+                         error_count=sum(bucket.error_count for bucket in buckets))
+
+
+def window_name(seconds):
+    for unit, unit_seconds in (('h', 3600), ('m', 60)):
+        if seconds % unit_seconds == 0:
+            return '{}{}'.format(seconds // unit_seconds, unit)
+    return '{}s'.format(seconds)
+
+
+def write_live_reports(windows, config, now):
+    # html: a report per window, json: all windows in one file to be served as is
+    statistics = [(window_name(seconds), windows.statistic(seconds, now)) for seconds in windows.windows]
+    if getattr(config, 'FOLLOW_OUTPUT', 'html') == 'json':
+        if not os.path.exists(config.REPORT_DIR):
+            os.makedirs(config.REPORT_DIR)
+        live_path = os.path.join(config.REPORT_DIR, LIVE_JSON_NAME)
+        with open(live_path + '.tmp', 'w', encoding='utf-8') as fw:
+            json.dump({
+                'updated': datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+                'windows': {name: {'requests': statistic.url_count, 'errors': statistic.error_count,
+                                   'table': list(report_statistic(statistic, config))}
+                            for name, statistic in statistics},
+            }, fw, ensure_ascii=False)
+        os.replace(live_path + '.tmp', live_path)
+        return
+    for name, statistic in statistics:
+        generate_report(report_statistic(statistic, config), config, None, REPORT_TEMPLATE_PATH,
+                        report_name=LIVE_REPORT_NAME.format(name))
+
+
+def generate_breakdown_reports(statistic, config, report_name):
+    # every breakdown is a table of its own next to the report: report-YYYY.MM.DD-status.html, -hours.html
+    breakdowns = statistic.breakdowns
+    if breakdowns is None:
+        return
+    report_base = report_name[:-len('.html')] if report_name.endswith('.html') else report_name
+    if breakdowns.status is not None:
+        generate_report(status_report(statistic, config), config, None, REPORT_TEMPLATE_PATH,
+                        report_name=report_base + '-status.html')
+    if breakdowns.hours is not None:
+        generate_report(hours_report(statistic), config, None, REPORT_TEMPLATE_PATH,
+                        report_name=report_base + '-hours.html')
+
+
+class RunMetrics(object):
+    '''
+    Timings and throughput of one log processing. Stages are timed with
+    stage(); a lazy iterator wrapped with timed_iter() is timed only while
+    it produces items, so the time of nested stages is also counted in the
+    stage around them.
+    '''
+    def __init__(self):
+        self.stages = {}
+        self.values = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.stages[name] = {'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu}
+
+    def timed_iter(self, iterable, name):
+        wall = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    wall += time.perf_counter() - started
+                yield item
+        finally:
+            self.stages[name] = {'wall': wall}
+
+    def summary(self):
+        summary = dict(self.values, stages=self.stages)
+        read_wall = self.stages.get('aggregate', {}).get('wall')
+        if read_wall:
+            summary['lines_per_sec'] = summary.get('total_lines', 0) / read_wall
+            summary['bytes_per_sec'] = summary.get('compressed_bytes', 0) / read_wall
+            if summary.get('decompressed_bytes') is not None:
+                summary['decompressed_bytes_per_sec'] = summary['decompressed_bytes'] / read_wall
+        if summary.get('total_lines'):
+            summary['error_ratio'] = summary.get('error_lines', 0) / float(summary['total_lines'])
+        if resource:
+            # ru_maxrss is in kilobytes on Linux, workers are counted as children
+            summary['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            summary['children_peak_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            summary['children_cpu'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_utime
+        return summary
+
+    def prometheus(self, summary):
+        lines = []
+        for name, values in summary['stages'].items():
+            for kind, value in values.items():
+                lines.append('log_analyzer_stage_{}_seconds{{stage="{}"}} {}'.format(kind, name, value))
+        for name, value in sorted(summary.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append('log_analyzer_{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def write_metrics(run_metrics, config, logger):
+    summary = run_metrics.summary()
+    logger.info('metrics {}'.format(json.dumps(summary, sort_keys=True)))
+    textfile = getattr(config, 'METRICS_TEXTFILE', None)
+    if textfile:
+        with open(textfile + '.tmp', 'w') as metrics_file:
+            metrics_file.write(run_metrics.prometheus(summary))
+        os.replace(textfile + '.tmp', textfile)
+
+
+def aggregate_log(log_meta, config, logger, run_metrics=None, day_cache=False):
+    parser = config_parser(config)
+    workers = getattr(config, 'WORKERS', 1)
+    block_size = getattr(config, 'GZIP_BLOCK_SIZE', 0)
+    queue_size = getattr(config, 'GZIP_QUEUE_SIZE', 8)
+    errors_limit = getattr(config, 'ERRORS_LIMIT', None)
+    warmup_lines = getattr(config, 'ERRORS_WARMUP_LINES', 10000)
+    options = aggregate_options(config, day_cache)
+    max_memory_mb = getattr(config, 'MAX_MEMORY_MB', None)
+    if max_memory_mb:
+        # the budget is kept by a single process, the python engine spills its store to disk
+        workers = 1
+        options = options._replace(cache_accuracy=None)
+        aggregate = functools.partial(aggregate_spilling, max_bytes=int(max_memory_mb * 1024 * 1024),
+                                      partitions=getattr(config, 'SPILL_PARTITIONS', 16),
+                                      spill_dir=getattr(config, 'SPILL_DIR', None))
+    else:
+        aggregate = get_engine(config)
+    if workers > 1 and log_meta.expansion == '.gz' and block_size:
+        logger.info('Reading the gzipped log with {} parser processes'.format(workers))
+        return aggregate_gzip_parallel(log_meta, parser, workers, block_size, queue_size, options,
+                                       errors_limit, warmup_lines)
+    if workers > 1 and log_meta.expansion != '.gz':
+        logger.info('Reading the log in {} processes'.format(workers))
+        return aggregate_log_parallel(log_meta, parser, workers, options, errors_limit, warmup_lines)
+    metrics = {}
+    log_lines = xreadlines(log_meta, logger, parser=parser, errors_limit=errors_limit, block_size=block_size,
+                           queue_size=queue_size, warmup_lines=warmup_lines, metrics=metrics)
+    # the read throughput is derived from the whole aggregate stage, timing every line costs up to 20%
+    statistic = aggregate(log_lines, options)
+    if run_metrics:
+        run_metrics.values['decompressed_bytes'] = metrics['bytes']
+    return statistic._replace(error_count=metrics['errors'])
+
+
+def save_day_statistic(statistic, log_meta, config, logger):
+    if not getattr(config, 'CACHE_DIR', None):
+        return statistic
+    if isinstance(statistic.store, SpilledStore):
+        logger.info('Aggregates of {} are spilled to disk and are not cached'.format(log_meta.date))
+        return statistic
+    statistic = sketch_statistic(statistic, getattr(config, 'SKETCH_ACCURACY', 0.01))
+    save_day_cache(day_cache_path(config, log_meta.date), statistic)
+    logger.info('Aggregates of {} are cached'.format(log_meta.date))
+    return statistic
 
 
 def main(config, logger):
     LogMeta = namedtuple('LogMeta', ['path', 'date', 'expansion'])
-    log_meta = find_last_log(config, LogMeta)
+    run_metrics = RunMetrics()
+    with run_metrics.stage('find_last_log'):
+        log_meta = find_last_log(config, LogMeta)
     if not log_meta:
         logger.info('Sorry. No logs found!!!!')
         return
     logger.info('Find last log file: {}'.format(log_meta.path))
 
     logger.info('Checking the report')
-    if os.path.exists(config.REPORT_DIR) and os.listdir(config.REPORT_DIR):
-        exist = check_current_report_done(log_meta, config)
-        if exist:
-            logger.info('The report has already been generated')
-            return
+    if check_current_report_done(log_meta, config):
+        logger.info('The report has already been generated')
+        return
+
+    process_log(log_meta, config, logger, run_metrics)
+
 
+def process_log(log_meta, config, logger, run_metrics=None):
+    run_metrics = run_metrics or RunMetrics()
+    run_metrics.values.update(log=log_meta.path, compressed_bytes=os.path.getsize(log_meta.path))
     logger.info('Start reading the log')
     try:
-        log_lines_it = xreadlines(log_meta, logger, parser=parserline)
+        with run_metrics.stage('aggregate'):
+            statistic = aggregate_log(log_meta, config, logger, run_metrics, day_cache=True)
     except RuntimeError as e:
         logger.exception('msg: {}'.format(e), exc_info=True)
+        return False
+    logger.info('Parsed lines: {}, unparseable lines: {}'.format(statistic.url_count, statistic.error_count))
+    run_metrics.values.update(total_lines=statistic.url_count + statistic.error_count,
+                              error_lines=statistic.error_count)
 
-    staticticit = cals_statistic(log_lines_it, config)
+    staticticit = run_metrics.timed_iter(report_statistic(statistic, config), 'report_statistic')
     logger.info('Statistics calculation is finished')
-    generate_report(staticticit, config, log_meta, REPORT_TEMPLATE_PATH)
+    with run_metrics.stage('generate_report'):
+        # the daily report is the last one, its presence means the log is done
+        generate_breakdown_reports(statistic, config, generate_report_name(log_meta))
+        generate_report(staticticit, config, log_meta, REPORT_TEMPLATE_PATH)
     logger.info('Calculation generation is finished')
+    # a spilled store counts its urls while the report merges it
+    run_metrics.values['distinct_urls'] = len(statistic.store)
+    # the cache is written after the report, a failed cache write does not cost the report
+    with run_metrics.stage('save_day_statistic'):
+        save_day_statistic(statistic, log_meta, config, logger)
+    write_metrics(run_metrics, config, logger)
+    return True
+
+
+def backfill_log(log_meta, config_fields):
+    # runs in a pool process, the config namedtuple type is rebuilt from its fields
+    config = namedtuple('Config', sorted(config_fields))(**config_fields)
+    logger = logging.getLogger('log_analyzer')
+    if not logger.handlers:
+        logger = create_logger(config_fields.get('SCRIPT_LOG_PATH'))
+    started = time.perf_counter()
+    if not process_log(log_meta, config, logger):
+        return None
+    return time.perf_counter() - started
+
+
+def main_backfill(config, logger):
+    log_metas = find_unreported_logs(config)
+    if not log_metas:
+        logger.info('Every log already has a report')
+        return
+    workers = max(1, min(getattr(config, 'BACKFILL_WORKERS', os.cpu_count() or 1), len(log_metas)))
+    logger.info('Found {} logs without reports, processing them in {} processes'.format(len(log_metas), workers))
+
+    # the logs are processed concurrently, so every log is read by a single process
+    config_fields = config._asdict()
+    config_fields['WORKERS'] = 1
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(backfill_log, log_meta, config_fields): log_meta for log_meta in log_metas}
+        for done, future in enumerate(as_completed(futures), 1):
+            log_meta = futures[future]
+            try:
+                elapsed = future.result()
+            except Exception:
+                logger.exception('[{}/{}] Failed to process {}'.format(done, len(log_metas), log_meta.path))
+                continue
+            if elapsed is None:
+                logger.error('[{}/{}] Failed to process {}, no report is generated'.format(
+                    done, len(log_metas), log_meta.path))
+                continue
+            logger.info('[{}/{}] {} is processed in {:.1f}s'.format(done, len(log_metas), log_meta.path, elapsed))
+    logger.info('Backfill of {} logs is finished in {:.1f}s'.format(len(log_metas), time.perf_counter() - started))
+
+
+def main_range(config, logger, date_range):
+    dates = parse_date_range(date_range)
+    statistics = []
+    for date in dates:
+        cache_path = day_cache_path(config, date)
+        if cache_path and os.path.exists(cache_path):
+            statistics.append(load_day_cache(cache_path))
+            continue
+        log_meta = find_log_by_date(config, date)
+        if not log_meta:
+            logger.info('No log and no cached aggregates for {}'.format(date))
+            continue
+        logger.info('Aggregates of {} are not cached, reading {}'.format(date, log_meta.path))
+        # days are merged in memory as sketches, like the cached ones, also when the log was spilled to disk
+        statistic = sketch_statistic(aggregate_log(log_meta, config, logger, day_cache=True),
+                                     getattr(config, 'SKETCH_ACCURACY', 0.01))
+        statistics.append(save_day_statistic(statistic, log_meta, config, logger))
+
+    if not statistics:
+        logger.info('Sorry. No logs found!!!!')
+        return
+    report_name = generate_range_report_name(dates[0], dates[-1])
+    generate_report(report_statistic(merge_statistic(statistics), config), config, None, REPORT_TEMPLATE_PATH,
+                    report_name=report_name)
+    logger.info('Report {} is generated from {} days'.format(report_name, len(statistics)))
+
+
+def main_incremental(config, logger):
+    path = os.path.join(config.LOG_DIR, getattr(config, 'CURRENT_LOG_NAME', CURRENT_LOG_NAME))
+    if not os.path.exists(path):
+        logger.info('Sorry. No current log found!!!!')
+        return
+    log_meta = LogMeta(path=path, date=datetime.now().strftime('%Y%m%d'), expansion='')
+
+    checkpoint_path = getattr(config, 'CHECKPOINT_PATH', './checkpoint/nginx-access-ui.pickle')
+    checkpoint = update_checkpoint(load_checkpoint(checkpoint_path), log_meta, config_parser(config),
+                                   aggregate_options(config))
+    logger.info('The log is aggregated up to byte {}'.format(checkpoint.offset))
+
+    generate_report(report_statistic(checkpoint.statistic, config), config, log_meta, REPORT_TEMPLATE_PATH,
+                    report_name=CURRENT_REPORT_NAME)
+    save_checkpoint(checkpoint_path, checkpoint)
+    logger.info('Current report is refreshed')
+
+
+def main_follow(config, logger):
+    path = os.path.join(config.LOG_DIR, getattr(config, 'CURRENT_LOG_NAME', CURRENT_LOG_NAME))
+    parser = get_parser(config_parser(config))
+    decode = not getattr(parser, 'accepts_bytes', False)
+    windows = SlidingWindows(getattr(config, 'FOLLOW_WINDOWS', [60, 300, 3600]),
+                             getattr(config, 'FOLLOW_BUCKET_SECONDS', 10), aggregate_options(config))
+    interval = getattr(config, 'FOLLOW_INTERVAL', 10)
+    logger.info('Following {}'.format(path))
+
+    next_report = time.time() + interval
+    for lines in follow_log(path, poll_interval=min(1.0, interval)):
+        now = time.time()
+        windows.add_lines((parser(line.decode('utf-8') if decode else line) for line in lines), now)
+        if now >= next_report:
+            write_live_reports(windows, config, now)
+            next_report = now + interval
+
+
+def main_columns(config, logger, date, url_filter=None):
+    if not is_log_date(date):
+        raise ValueError('Wrong date {}, expected YYYYMMDD'.format(date))
+    path = columns_path(config, date)
+    if not columns_complete(path):
+        log_meta = find_log_by_date(config, date)
+        if not log_meta:
+            logger.info('Sorry. No log found for {}'.format(date))
+            return
+        export_columns(log_meta, config, path)
+        logger.info('Parsed log {} is saved to {}'.format(log_meta.path, path))
+
+    columns = load_columns(path)
+    statistic = aggregate_columns(columns, config, re.compile(url_filter) if url_filter else None)
+    report_name = columns_report_name(date)
+    generate_breakdown_reports(statistic, config, report_name)
+    generate_report(report_statistic(statistic, config), config, None, REPORT_TEMPLATE_PATH, report_name=report_name)
+    logger.info('Report {} is generated from {} rows'.format(report_name, statistic.url_count))
 
 
 if __name__ == "__main__":
@@ -242,9 +2396,11 @@ if __name__ == "__main__":
 
     if args.config_path:
         with open(args.config_path, 'rb') as conf:
-            ext_config = json.load(conf, encoding='utf-8')
+            ext_config = json.load(conf)
 
     config.update(ext_config)
+    if args.workers:
+        config['WORKERS'] = args.workers
 
     logger = create_logger(config.get('SCRIPT_LOG_PATH'))
     logger.info('Analyzer start work')
@@ -253,6 +2409,17 @@ if __name__ == "__main__":
     config = Config(**config)
 
     try:
-        main(config, logger)
+        if args.incremental:
+            main_incremental(config, logger)
+        elif args.backfill:
+            main_backfill(config, logger)
+        elif args.date_range:
+            main_range(config, logger, args.date_range)
+        elif args.follow:
+            main_follow(config, logger)
+        elif args.columns_date:
+            main_columns(config, logger, args.columns_date, args.url_filter)
+        else:
+            main(config, logger)
     except:
-        logger.exception('Something wrong')
\ No newline at end of file
+        logger.exception('Something wrong')
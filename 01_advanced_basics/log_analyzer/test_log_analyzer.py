@@ -1,8 +1,15 @@
 import unittest
+from array import array
+import benchmark
 import log_analyzer
 from collections import namedtuple
 import os
 import shutil
+import gzip
+import json
+import random
+import re
+import tempfile
 
 class TestBasic(unittest.TestCase):
     def setUp(self):
@@ -34,6 +41,32 @@ class TestBasic(unittest.TestCase):
         self.assertEqual(self.get_parse_result(self.correct_line), ('/api/v2/slot/4822/groups', 0.345),
                          'Should be tuple of (/api/v2/slot/4822/groups, 0.345')
 
+    def test_split_parser_line(self):
+        self.assertEqual(log_analyzer.parserline_split(self.correct_line), ('/api/v2/slot/4822/groups', 0.345))
+        self.assertEqual(log_analyzer.parserline_split(self.invalid_line), None, 'Should be None')
+        self.assertEqual(log_analyzer.parserline_split(''), None, 'Should be None')
+
+    def test_bytes_parser_line(self):
+        for name in ('bytes', 'bytes_split'):
+            parser = log_analyzer.get_parser(name)
+            self.assertEqual(parser(self.correct_line.encode('utf-8')), ('/api/v2/slot/4822/groups', 0.345))
+            self.assertEqual(parser(self.invalid_line.encode('utf-8')), None, 'Should be None')
+            url, _ = parser(self.correct_line.encode('utf-8'))
+            self.assertIs(url, parser(self.correct_line.encode('utf-8'))[0], 'url should be decoded once')
+
+    def test_bytes_url_cache(self):
+        parser = log_analyzer.BytesRegexParser()
+        parser.cache_size = 10
+        for i in range(25):
+            url, _ = parser(self.correct_line.replace('4822', str(i)).encode('utf-8'))
+            self.assertEqual(url, '/api/v2/slot/{}/groups'.format(i))
+            self.assertLessEqual(len(parser.urls), 10)
+
+    def test_get_parser(self):
+        self.assertIs(log_analyzer.get_parser('split'), log_analyzer.parserline_split)
+        self.assertIs(log_analyzer.get_parser(log_analyzer.parserline), log_analyzer.parserline)
+        self.assertRaises(ValueError, log_analyzer.get_parser, 'unknown')
+
     def test_ok_calc_statistic(self):
         # statistic_gen = (row for row in self.one_url_statistic)
         statistic_gen = (row for row in self.one_url_statistic)
@@ -47,6 +80,608 @@ class TestBasic(unittest.TestCase):
                                'time_sum': 4.29,
                                'url': '/api/v2/banner/25019354'}], 'wrong calc statistic')
 
+    def test_report_top_urls(self):
+        lines = [('/url/{}'.format(i), i / 10.0) for i in range(1, 10)] + [('/url/1', 0.1)] * 20
+        config = namedtuple('Config', ['REPORT_SIZE', 'REPORT_SORT_KEY'])
+        rows = list(log_analyzer.cals_statistic(iter(lines), config(REPORT_SIZE=3, REPORT_SORT_KEY='time_avg')))
+        self.assertListEqual([row['url'] for row in rows], ['/url/9', '/url/8', '/url/7'])
+        rows = list(log_analyzer.cals_statistic(iter(lines), config(REPORT_SIZE=2, REPORT_SORT_KEY='count')))
+        self.assertListEqual([row['url'] for row in rows], ['/url/1', '/url/2'])
+        self.assertRaises(ValueError, list,
+                          log_analyzer.cals_statistic(iter(lines), config(REPORT_SIZE=2, REPORT_SORT_KEY='url')))
+
+    @unittest.skipIf(log_analyzer.np is None, 'numpy is not installed')
+    def test_numpy_engine(self):
+        rnd = random.Random(1)
+        lines = [('/url/{}'.format(rnd.randint(1, 50)), round(rnd.random() * rnd.choice([1, 10]), 3))
+                 for _ in range(5000)]
+        config = namedtuple('Config', ['REPORT_SIZE', 'REPORT_SORT_KEY', 'PERCENTILES', 'ENGINE'])
+        for sort_key in log_analyzer.REPORT_SORT_KEYS:
+            expected = list(log_analyzer.cals_statistic(iter(lines), config(20, sort_key, [90, 99], 'python')))
+            rows = list(log_analyzer.cals_statistic(iter(lines), config(20, sort_key, [90, 99], 'numpy')))
+            self.assertEqual(repr(rows), repr(expected), sort_key)
+
+    def test_spilled_statistic(self):
+        rnd = random.Random(3)
+        lines = [('/url/{}'.format(rnd.randint(1, 3000)), round(rnd.random() * rnd.choice([1, 10]), 3))
+                 for _ in range(35000)]
+        config = namedtuple('Config', ['REPORT_SIZE', 'REPORT_SORT_KEY', 'PERCENTILES'])
+        statistic = log_analyzer.aggregate_spilling(iter(lines), max_bytes=200000, partitions=4)
+        self.assertIsInstance(statistic.store, log_analyzer.SpilledStore)
+        self.assertEqual(statistic.store.spills, 4)
+        self.assertEqual(len(statistic.store), len(set(url for url, _ in lines)))
+        for sort_key in log_analyzer.REPORT_SORT_KEYS:
+            expected = list(log_analyzer.cals_statistic(iter(lines), config(20, sort_key, [90])))
+            rows = list(log_analyzer.report_statistic(statistic, config(20, sort_key, [90])))
+            self.assertEqual(repr(rows), repr(expected), sort_key)
+
+        sketch = log_analyzer.AggregateOptions(accuracy=0.01)
+        statistic = log_analyzer.aggregate_spilling(iter(lines), sketch, max_bytes=200000, partitions=4)
+        expected = log_analyzer.aggregate_statistic(iter(lines), sketch)
+        self.assertEqual(repr(list(log_analyzer.report_statistic(statistic, config(20, 'p99', [90])))),
+                         repr(list(log_analyzer.report_statistic(expected, config(20, 'p99', [90])))))
+
+        spill_path = statistic.store.path
+        del statistic
+        self.assertFalse(os.path.exists(spill_path))
+        statistic = log_analyzer.aggregate_spilling(iter(lines[:100]), max_bytes=1000)
+        self.assertIsInstance(statistic.store, dict)
+
+        # a partition over the budget is split again for the merge
+        statistic = log_analyzer.aggregate_spilling(iter(lines), max_bytes=200000, partitions=2)
+        rows = list(log_analyzer.report_statistic(statistic, config(20, 'time_sum', [90])))
+        self.assertEqual(repr(rows), repr(list(log_analyzer.cals_statistic(iter(lines), config(20, 'time_sum', [90])))))
+        self.assertGreater(len(statistic.store.merge_paths), 2)
+        self.assertEqual(len(statistic.store), len(set(url for url, _ in lines)))
+
+    def test_url_statistic_merge(self):
+        store, first, second = {}, {}, {}
+        for i, (url, request_time) in enumerate(self.one_url_statistic):
+            log_analyzer.update_statistic_store(store, url, request_time)
+            log_analyzer.update_statistic_store(first if i < 4 else second, url, request_time)
+        log_analyzer.merge_statistic_store(first, second)
+        rec, merged = store['/api/v2/banner/25019354'], first['/api/v2/banner/25019354']
+        self.assertEqual(rec.samples.typecode, 'd')
+        self.assertEqual((merged.count, merged.time_max, list(merged.samples)),
+                         (rec.count, rec.time_max, list(rec.samples)))
+        self.assertAlmostEqual(merged.time_sum, rec.time_sum)
+
+    def test_quantile_sketch(self):
+        samples = [(i % 997) / 100.0 for i in range(20000)]
+        sketch = log_analyzer.QuantileSketch(0.01)
+        other = log_analyzer.QuantileSketch(0.01)
+        for i, value in enumerate(samples):
+            (sketch if i % 2 else other).append(value)
+        sketch.merge(other)
+        self.assertEqual(sketch.count, len(samples))
+        qs = [0.5, 0.9, 0.99, 0.999]
+        for estimate, exact in zip(sketch.quantiles(qs), log_analyzer.exact_quantiles(samples, qs)):
+            self.assertLessEqual(abs(estimate - exact), exact * 0.01 + 1e-9)
+
+    def test_sketch_calc_statistic(self):
+        config = namedtuple('Config', ['REPORT_SIZE', 'AGGREGATION', 'SKETCH_ACCURACY', 'PERCENTILES'])(
+            REPORT_SIZE=1000, AGGREGATION='sketch', SKETCH_ACCURACY=0.01, PERCENTILES=[90, 99.9])
+        rows = list(log_analyzer.cals_statistic(iter(self.one_url_statistic), config))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['count'], 10)
+        self.assertEqual(rows[0]['time_sum'], 4.29)
+        for column in ('time_med', 'time_p90', 'time_p999'):
+            self.assertAlmostEqual(rows[0][column], 0.39, delta=0.39 * 0.01)
+
+    def test_url_normalization(self):
+        config = namedtuple('Config', ['REPORT_SIZE', 'URL_QUERY', 'URL_KEEP_PARAMS', 'URL_COLLAPSE_IDS',
+                                       'URL_MAX_CARDINALITY'])
+        normalizer = log_analyzer.UrlNormalizer(
+            log_analyzer.url_normalization(config(10, 'strip', ['date_type'], True, None)))
+        self.assertEqual(normalizer('/api/v2/banner/25019354'), '/api/v2/banner/{id}')
+        self.assertEqual(normalizer('/api/v2/group/7786679/statistic/sites/?date_type=day&date_from=2017-06-28'),
+                         '/api/v2/group/{id}/statistic/sites/?date_type=day')
+        self.assertEqual(normalizer('/export/8c1c1b3e-3f0a-4e4f-9d35-6d2b1c0a9e11/?_=1498697422'),
+                         '/export/{uuid}/')
+        self.assertIsNone(log_analyzer.url_normalization(config(10, 'keep', [], False, None)))
+        normalizer = log_analyzer.UrlNormalizer(log_analyzer.url_normalization(config(10, 'keep', [], True, None)))
+        self.assertEqual(normalizer('/api/v2/banner/123?x=1'), '/api/v2/banner/{id}?x={id}')
+        self.assertEqual(normalizer('/api/v2/banner/123#top'), '/api/v2/banner/{id}#top')
+
+        lines = [('/api/v2/banner/{}?_={}'.format(i % 3, i), 1.0) for i in range(100)]
+        lines += [('/random/{}'.format(i), 2.0) for i in range(100)]
+        rows = list(log_analyzer.cals_statistic(iter(lines), config(10, 'strip', [], False, 4)))
+        counts = {row['url']: row['count'] for row in rows}
+        self.assertEqual(counts, {'/api/v2/banner/0': 34, '/api/v2/banner/1': 33, '/api/v2/banner/2': 33,
+                                  '/random/0': 1, '(other)': 99})
+
+
+class TestReadLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.lines = ['1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/{} HTTP/1.1" 200 927 '
+                      '"-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.{}{}\n'
+                      .format(i % 7, i % 7, i % 10) for i in range(100)] + ['broken line\n']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_log(self, expansion=''):
+        path = os.path.join(self.tmp_dir, 'nginx-access-ui.log-20170630' + expansion)
+        opener = gzip.open if expansion == '.gz' else open
+        with opener(path, 'wb') as log:
+            log.write(''.join(self.lines).encode('utf-8'))
+        return log_analyzer.LogMeta(path=path, date='20170630', expansion=expansion)
+
+    def test_parsers_agree(self):
+        for expansion in ('', '.gz'):
+            log_meta = self.write_log(expansion)
+            expected = list(log_analyzer.xreadlines(log_meta, None, parser='regex'))
+            self.assertEqual(len(expected), 100)
+            for name in log_analyzer.LINE_PARSERS:
+                self.assertListEqual(list(log_analyzer.xreadlines(log_meta, None, parser=name)), expected, name)
+
+    def test_gzip_pipeline(self):
+        log_meta = self.write_log('.gz')
+        expected = list(log_analyzer.xreadlines(log_meta, None))
+        self.assertListEqual(list(log_analyzer.xreadlines(log_meta, None, block_size=1000, queue_size=2)), expected)
+        self.assertListEqual(list(log_analyzer.xreadlines(log_meta, None, block_size=50, queue_size=1)), expected)
+
+        config = namedtuple('Config', ['REPORT_SIZE'])(REPORT_SIZE=1000)
+        statistic = log_analyzer.aggregate_gzip_parallel(log_meta, 'bytes', 2, 1000, 2)
+        self.assertListEqual(list(log_analyzer.report_statistic(statistic, config)),
+                             list(log_analyzer.cals_statistic(iter(expected), config)))
+
+    def test_incremental_checkpoint(self):
+        log_meta = self.write_log()
+        config = namedtuple('Config', ['REPORT_SIZE'])(REPORT_SIZE=1000)
+        expected = list(log_analyzer.cals_statistic(log_analyzer.xreadlines(log_meta, None), config))
+        with open(log_meta.path, 'rb') as log:
+            data = log.read()
+        with open(log_meta.path, 'wb') as log:
+            log.write(data[:len(data) // 2])
+
+        checkpoint_path = os.path.join(self.tmp_dir, 'checkpoint', 'log.pickle')
+        checkpoint = log_analyzer.update_checkpoint(None, log_meta, 'regex')
+        log_analyzer.save_checkpoint(checkpoint_path, checkpoint)
+        self.assertLessEqual(checkpoint.offset, len(data) // 2)
+        self.assertEqual(data[checkpoint.offset - 1:checkpoint.offset], b'\n')
+
+        with open(log_meta.path, 'ab') as log:
+            log.write(data[len(data) // 2:])
+        checkpoint = log_analyzer.update_checkpoint(log_analyzer.load_checkpoint(checkpoint_path), log_meta, 'regex')
+        self.assertEqual(checkpoint.offset, len(data))
+        self.assertListEqual(list(log_analyzer.report_statistic(checkpoint.statistic, config)), expected)
+
+        # the url cardinality is bounded over all runs
+        options = log_analyzer.AggregateOptions(
+            accuracy=None, normalization=log_analyzer.UrlNormalization(False, (), False, max_cardinality=3))
+        with open(log_meta.path, 'wb') as log:
+            log.write(data[:len(data) // 2])
+        checkpoint = log_analyzer.update_checkpoint(None, log_meta, 'regex', options)
+        with open(log_meta.path, 'ab') as log:
+            log.write(data[len(data) // 2:])
+        checkpoint = log_analyzer.update_checkpoint(checkpoint, log_meta, 'regex', options)
+        self.assertEqual(len(checkpoint.statistic.store), 4)
+        # banners 0, 1 and 2 are kept, the other four are counted as one url
+        self.assertEqual(checkpoint.statistic.store[log_analyzer.OTHER_URL].count, 56)
+
+    def test_errors_limit(self):
+        self.lines = self.lines[:10] + ['broken line\n'] * 5000 + self.lines[10:]
+        log_meta = self.write_log()
+        metrics = {}
+        with self.assertRaises(RuntimeError):
+            for _ in log_analyzer.xreadlines(log_meta, None, errors_limit=0.2, warmup_lines=100, metrics=metrics):
+                pass
+        # the reading stops right after the warm-up sample
+        self.assertEqual(metrics['total_lines'], 100)
+        self.assertEqual(metrics['errors'], 90)
+
+        metrics = {}
+        self.assertEqual(len(list(log_analyzer.xreadlines(log_meta, None, metrics=metrics))), 100)
+        self.assertDictEqual(metrics, {'total_lines': 5101, 'processed': 100, 'errors': 5001,
+                                       'bytes': os.path.getsize(log_meta.path)})
+        with self.assertRaises(RuntimeError):
+            log_analyzer.aggregate_log_parallel(log_meta, 'regex', 2, errors_limit=0.2, warmup_lines=100)
+        statistic = log_analyzer.aggregate_log_parallel(log_meta, 'regex', 2)
+        self.assertEqual((statistic.url_count, statistic.error_count), (100, 5001))
+
+    def test_generated_log(self):
+        for expansion in ('', '.gz'):
+            path = os.path.join(self.tmp_dir, 'nginx-access-ui.log-20170630' + expansion)
+            benchmark.generate_log(path, 2000, urls=50, malformed=0.1, compress=bool(expansion))
+            log_meta = log_analyzer.LogMeta(path=path, date='20170630', expansion=expansion)
+            metrics = {}
+            parsed_lines = list(log_analyzer.xreadlines(log_meta, None, metrics=metrics))
+            self.assertEqual(metrics['total_lines'], 2000)
+            self.assertAlmostEqual(metrics['errors'] / 2000.0, 0.1, delta=0.03)
+            self.assertLessEqual(len(set(url for url, _ in parsed_lines)), 50)
+            for name in log_analyzer.LINE_PARSERS:
+                self.assertListEqual(list(log_analyzer.xreadlines(log_meta, None, parser=name)), parsed_lines, name)
+
+    def test_split_log(self):
+        log_meta = self.write_log()
+        ranges = log_analyzer.split_log(log_meta.path, 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(log_meta.path))
+        lines = []
+        for start, end in ranges:
+            lines.extend(log_analyzer.xreadlines(log_meta, None, start=start, end=end))
+        self.assertListEqual(lines, list(log_analyzer.xreadlines(log_meta, None)))
+
+    def test_mapped_reader(self):
+        self.lines[-1] = self.lines[0].rstrip('\n')
+        log_meta = self.write_log()
+        for name in ('bytes', 'bytes_split'):
+            metrics = {}
+            expected = list(log_analyzer.xreadlines(log_meta, None, parser=name, use_mmap=False))
+            self.assertEqual(len(expected), 101)
+            self.assertListEqual(list(log_analyzer.xreadlines(log_meta, None, parser=name, metrics=metrics)),
+                                 expected, name)
+            self.assertEqual(metrics['bytes'], os.path.getsize(log_meta.path))
+            lines = []
+            for start, end in log_analyzer.split_log(log_meta.path, 3):
+                lines.extend(log_analyzer.xreadlines(log_meta, None, parser=name, start=start, end=end))
+            self.assertListEqual(lines, expected, name)
+
+        self.lines = []
+        log_meta = self.write_log()
+        self.assertListEqual(list(log_analyzer.xreadlines(log_meta, None, parser='bytes')), [])
+        self.assertListEqual(log_analyzer.split_log(log_meta.path, 3), [])
+
+    def test_log_formats(self):
+        log_meta = self.write_log()
+        expected = list(log_analyzer.xreadlines(log_meta, None))
+        parser = log_analyzer.format_parser('ui_short')
+        self.assertListEqual(list(log_analyzer.xreadlines(log_meta, None, parser=parser)), expected)
+        statistic = log_analyzer.aggregate_log_parallel(log_meta, parser, 2)
+        self.assertEqual((statistic.url_count, statistic.error_count), (100, 1))
+
+        parser = log_analyzer.format_parser('$remote_addr - [$time_local] $status ${request_uri} $request_time')
+        self.assertEqual(parser(b'10.0.0.1 - [29/Jun/2017:03:50:22 +0300] 200 /api/1/?id=5 0.390\n'),
+                         ('/api/1/?id=5', 0.39))
+        self.assertIsNone(parser(b'10.0.0.1 - [29/Jun/2017:03:50:22 +0300] 200 /api/1/?id=5 -\n'))
+        with self.assertRaises(ValueError):
+            log_analyzer.format_parser('$remote_addr [$time_local] "$request"')
+        with self.assertRaises(ValueError):
+            log_analyzer.format_parser('apache')
+
+        config = namedtuple('Config', ['LOG_FORMAT', 'JSON_URL_FIELD'])(LOG_FORMAT='json', JSON_URL_FIELD='path')
+        parser = log_analyzer.config_parser(config)
+        self.assertEqual(parser(b'{"path": "/api/v2/banner/1", "request_time": "0.390"}\n'), ('/api/v2/banner/1', 0.39))
+        self.assertEqual(parser(b'{"path": "GET /api/v2/banner/1 HTTP/1.1", "request_time": 0.39}'),
+                         ('/api/v2/banner/1', 0.39))
+        for line in (b'{"path": "/api/v2/banner/1"}', b'{"path": "/", "request_time": "-"}', b'[1, 2]', b'{"pa'):
+            self.assertIsNone(parser(line), line)
+
+    def test_follow_log(self):
+        path = os.path.join(self.tmp_dir, 'nginx-access-ui.log')
+        with open(path, 'wb') as log:
+            log.write(b'old line\n')
+        follow = log_analyzer.follow_log(path, poll_interval=0)
+        self.assertListEqual(next(follow), [])
+        with open(path, 'ab') as log:
+            log.write(b'first\nsecond\nthi')
+        self.assertListEqual(next(follow), [b'first', b'second'])
+        self.assertListEqual(next(follow), [])
+        with open(path, 'ab') as log:
+            log.write(b'rd\n')
+        self.assertListEqual(next(follow), [b'third'])
+
+        os.rename(path, path + '-20170630')
+        with open(path, 'wb') as log:
+            log.write(b'rotated\n')
+        self.assertListEqual(next(follow), [b'rotated'])
+        with open(path, 'wb') as log:
+            log.write(b'trunc\n')
+        self.assertListEqual(next(follow), [b'trunc'])
+        follow.close()
+
+    def test_sliding_windows(self):
+        rnd = random.Random(2)
+        lines = [('/url/{}'.format(rnd.randint(1, 5)), round(rnd.random(), 3)) for _ in range(300)]
+        windows = log_analyzer.SlidingWindows([60, 3600], bucket_seconds=10)
+        windows.add_lines(lines[:100], 500.0)
+        windows.add_lines(lines[100:200] + [None], 3000.0)
+        windows.add_lines(lines[200:], 4500.0)
+        config = namedtuple('Config', ['REPORT_SIZE', 'REPORT_DIR', 'FOLLOW_OUTPUT'])(
+            REPORT_SIZE=10, REPORT_DIR=os.path.join(self.tmp_dir, 'reports'), FOLLOW_OUTPUT='json')
+
+        statistic = windows.statistic(60, 4505.0)
+        self.assertEqual((statistic.url_count, statistic.error_count), (100, 0))
+        self.assertListEqual(list(log_analyzer.report_statistic(statistic, config)),
+                             list(log_analyzer.cals_statistic(iter(lines[200:]), config)))
+        statistic = windows.statistic(3600, 4505.0)
+        self.assertEqual((statistic.url_count, statistic.error_count), (200, 1))
+        self.assertListEqual(list(log_analyzer.report_statistic(statistic, config)),
+                             list(log_analyzer.cals_statistic(iter(lines[100:]), config)))
+        # reporting does not change the buckets
+        self.assertEqual(windows.statistic(3600, 4505.0).store['/url/1'].count,
+                         statistic.store['/url/1'].count)
+
+        log_analyzer.write_live_reports(windows, config, 4505.0)
+        with open(os.path.join(config.REPORT_DIR, 'live.json'), encoding='utf-8') as live:
+            live = json.load(live)
+        self.assertEqual(sorted(live['windows']), ['1h', '1m'])
+        self.assertEqual(live['windows']['1h']['errors'], 1)
+        self.assertEqual(sum(row['count'] for row in live['windows']['1m']['table']), 100)
+
+    def test_sliding_windows_cardinality(self):
+        options = log_analyzer.AggregateOptions(
+            accuracy=None, normalization=log_analyzer.UrlNormalization(False, (), False, max_cardinality=2))
+        windows = log_analyzer.SlidingWindows([60], bucket_seconds=10, options=options)
+        windows.add_lines([('/old/1', 0.1), ('/old/2', 0.1), ('/old/3', 0.1)], 100.0)
+        self.assertListEqual(sorted(windows.statistic(60, 100.0).store), ['(other)', '/old/1', '/old/2'])
+        windows.add_lines([('/new/1', 0.1)], 130.0)
+        self.assertEqual(windows.statistic(60, 130.0).store['(other)'].count, 2)
+        # the old urls have left the window
+        windows.add_lines([('/new/2', 0.1), ('/new/3', 0.1), ('/new/4', 0.1)], 200.0)
+        self.assertListEqual(sorted(windows.statistic(60, 200.0).store), ['(other)', '/new/2', '/new/3'])
+
+    def test_columns(self):
+        self.lines[3] = self.lines[3].replace('" 200 ', '" 404 ')
+        log_meta = self.write_log()
+        config = namedtuple('Config', ['REPORT_SIZE', 'REPORT_SORT_KEY', 'PERCENTILES', 'ENGINE'])(
+            REPORT_SIZE=5, REPORT_SORT_KEY='time_sum', PERCENTILES=[90], ENGINE='python')
+        path = os.path.join(self.tmp_dir, 'columns', '20170630')
+        log_analyzer.export_columns(log_meta, config, path)
+        columns = log_analyzer.load_columns(path)
+        self.assertEqual((columns.meta['rows'], columns.meta['errors']), (100, 1))
+        self.assertEqual(list(columns.timestamp[:2]), [1498697422, 1498697422])
+        self.assertEqual(list(columns.status[:5]), [200, 200, 200, 404, 200])
+
+        lines = list(log_analyzer.xreadlines(log_meta, None))
+        self.assertListEqual([(columns.urls[url_id], request_time)
+                              for url_id, request_time in zip(columns.url_id, columns.request_time)], lines)
+        url_filter = re.compile('/[135]$')
+        plain_columns = columns._replace(url_id=array('I', list(columns.url_id)),
+                                         request_time=array('d', list(columns.request_time)))
+        for aggregate_from in (columns, plain_columns):
+            statistic = log_analyzer.aggregate_columns(aggregate_from, config)
+            self.assertEqual(statistic.error_count, 1)
+            self.assertListEqual(list(log_analyzer.report_statistic(statistic, config)),
+                                 list(log_analyzer.cals_statistic(iter(lines), config)))
+            statistic = log_analyzer.aggregate_columns(aggregate_from, config, url_filter)
+            self.assertListEqual(list(log_analyzer.report_statistic(statistic, config)),
+                                 list(log_analyzer.cals_statistic(
+                                     (line for line in lines if url_filter.search(line[0])), config)))
+
+    def test_breakdowns(self):
+        for i in range(0, 100, 10):
+            self.lines[i] = self.lines[i].replace('" 200 ', '" 504 ').replace(':03:50:22', ':04:10:00')
+        self.lines[5] = self.lines[5].replace('" 200 ', '" 404 ')
+        log_meta = self.write_log()
+        config = namedtuple('Config', ['REPORT_SIZE', 'REPORT_DIR', 'BREAKDOWNS', 'WORKERS'])(
+            REPORT_SIZE=3, REPORT_DIR=os.path.join(self.tmp_dir, 'reports'), BREAKDOWNS=['status', 'hour'],
+            WORKERS=1)
+        statistic = log_analyzer.aggregate_log(log_meta, config, None)
+        self.assertListEqual(list(log_analyzer.report_statistic(statistic, config)),
+                             list(log_analyzer.cals_statistic(log_analyzer.xreadlines(log_meta, None),
+                                                              config._replace(BREAKDOWNS=[]))))
+        self.assertEqual(list(statistic.breakdowns.status['/api/v2/banner/0'][:5]), [0, 13, 0, 0, 2])
+
+        rows = list(log_analyzer.status_report(statistic, config))
+        self.assertListEqual([row['url'] for row in rows], ['/api/v2/banner/0', '/api/v2/banner/3', '/api/v2/banner/5'])
+        self.assertEqual((rows[2]['count'], rows[2]['count_4xx'], rows[2]['count_5xx']), (14, 1, 1))
+        rows = list(log_analyzer.hours_report(statistic))
+        self.assertListEqual([(row['hour'], row['count'], row['count_5xx']) for row in rows],
+                             [('2017-06-29 03:00', 90, 0), ('2017-06-29 04:00', 10, 10)])
+
+        parallel = log_analyzer.aggregate_log(log_meta, config._replace(WORKERS=2),
+                                              log_analyzer.logging.getLogger('test_log_analyzer'))
+        for counters, expected in ((parallel.breakdowns.status, statistic.breakdowns.status),
+                                   (parallel.breakdowns.hours, statistic.breakdowns.hours)):
+            self.assertDictEqual({key: [round(value, 6) for value in counter] for key, counter in counters.items()},
+                                 {key: [round(value, 6) for value in counter] for key, counter in expected.items()})
+
+        log_analyzer.generate_breakdown_reports(statistic, config, 'report-2017.06.30.html')
+        self.assertListEqual(sorted(os.listdir(config.REPORT_DIR)),
+                             ['report-2017.06.30-hours.html', 'report-2017.06.30-status.html'])
+        with self.assertRaises(ValueError):
+            log_analyzer.aggregate_options(config._replace(BREAKDOWNS=['referer']))
+
+        path = os.path.join(self.tmp_dir, 'columns', '20170630')
+        log_analyzer.export_columns(log_meta, config, path)
+        from_columns = log_analyzer.aggregate_columns(log_analyzer.load_columns(path), config)
+        self.assertDictEqual(from_columns.breakdowns.hours, statistic.breakdowns.hours)
+
+        # hours follow the zone of $time_local whatever the zone of the host is
+        parser = log_analyzer.record_parser(config)
+        times_local = (b'29/Jun/2017:00:10:00 +0530', b'29/Jun/2017:00:50:00 +0530', b'28/Jun/2017:23:59:59 -0100')
+        records = [parser(line.encode('utf-8').replace(b'29/Jun/2017:03:50:22 +0300', time_local))
+                   for line, time_local in zip(self.lines[1:], times_local)]
+        statistic = log_analyzer.aggregate_records(records, log_analyzer.aggregate_options(config))
+        self.assertListEqual([(row['hour'], row['count']) for row in log_analyzer.hours_report(statistic)],
+                             [('2017-06-28 23:00', 1), ('2017-06-29 00:00', 2)])
+
+    def test_parallel_url_cardinality(self):
+        self.lines = [line.replace('/api/v2/banner/', '/api/v2/banner/{}/'.format(i))
+                      for i, line in enumerate(self.lines[:100] * 20)]
+        options = log_analyzer.AggregateOptions(
+            accuracy=None, normalization=log_analyzer.UrlNormalization(False, (), False, max_cardinality=10))
+        config = namedtuple('Config', ['REPORT_SIZE'])(REPORT_SIZE=20)
+        for expansion in ('', '.gz'):
+            log_meta = self.write_log(expansion)
+            expected = log_analyzer.aggregate_statistic(log_analyzer.xreadlines(log_meta, None), options)
+            if expansion:
+                statistic = log_analyzer.aggregate_gzip_parallel(log_meta, 'regex', 2, 4096, 2, options)
+            else:
+                statistic = log_analyzer.aggregate_log_parallel(log_meta, 'regex', 3, options)
+            self.assertEqual(len(statistic.store), 11)
+            self.assertListEqual(list(statistic.store), list(expected.store))
+            self.assertDictEqual({row['url']: row['count'] for row in log_analyzer.report_statistic(statistic, config)},
+                                 {row['url']: row['count'] for row in log_analyzer.report_statistic(expected, config)})
+
+    def test_parallel_statistic(self):
+        log_meta = self.write_log()
+        config = namedtuple('Config', ['REPORT_SIZE'])(REPORT_SIZE=1000)
+        expected = list(log_analyzer.cals_statistic(log_analyzer.xreadlines(log_meta, None), config))
+        statistic = log_analyzer.aggregate_log_parallel(log_meta, 'regex', 3)
+        self.assertListEqual(list(log_analyzer.report_statistic(statistic, config)), expected)
+
+
+class TestDayCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        config = {
+            'REPORT_SIZE': 1000,
+            'REPORT_DIR': os.path.join(self.tmp_dir, 'reports'),
+            'LOG_DIR': os.path.join(self.tmp_dir, 'log'),
+            'CACHE_DIR': os.path.join(self.tmp_dir, 'cache'),
+            'BACKFILL_WORKERS': 2,
+        }
+        self.config = namedtuple('Config', sorted(config))(**config)
+        self.logger = log_analyzer.logging.getLogger('test_log_analyzer')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_date_range(self):
+        self.assertListEqual(log_analyzer.parse_date_range('20170629..20170702'),
+                             ['20170629', '20170630', '20170701', '20170702'])
+        self.assertListEqual(log_analyzer.parse_date_range('20170629'), ['20170629'])
+        self.assertRaises(ValueError, log_analyzer.parse_date_range, '20170702..20170629')
+
+    def write_logs(self):
+        os.makedirs(self.config.LOG_DIR)
+        line = '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {} HTTP/1.1" 200 927 "-" "Lynx" "-" ' \
+               '"1498697422-2190034393-4708-9752759" "dc7161be3" {}\n'
+        for date, request_time in (('20170629', 0.1), ('20170630', 0.3)):
+            with open(os.path.join(self.config.LOG_DIR, 'nginx-access-ui.log-' + date), 'w') as log:
+                log.write(line.format('/api/1', request_time) * 3 + line.format('/api/' + date, 1.0))
+
+    def test_run_metrics(self):
+        self.write_logs()
+        textfile = os.path.join(self.tmp_dir, 'log_analyzer.prom')
+        config = namedtuple('Config', self.config._fields + ('METRICS_TEXTFILE',))(*self.config, textfile)
+        with self.assertLogs('test_log_analyzer', level='INFO') as logs:
+            log_analyzer.main(config, self.logger)
+        summary = json.loads([line for line in logs.output if ':metrics ' in line][0].split(':metrics ', 1)[1])
+        self.assertEqual(summary['total_lines'], 4)
+        self.assertEqual(summary['distinct_urls'], 2)
+        self.assertEqual(summary['error_ratio'], 0.0)
+        self.assertEqual(summary['decompressed_bytes'], summary['compressed_bytes'])
+        self.assertTrue({'find_last_log', 'aggregate', 'report_statistic', 'generate_report'}
+                        <= set(summary['stages']))
+        self.assertGreater(summary['lines_per_sec'], 0)
+        with open(textfile) as metrics_file:
+            self.assertIn('log_analyzer_total_lines 4', metrics_file.read())
+
+    def test_backfill(self):
+        self.write_logs()
+        log_analyzer.main_backfill(self.config, self.logger)
+        self.assertListEqual(sorted(os.listdir(self.config.REPORT_DIR)),
+                             ['report-2017.06.29.html', 'report-2017.06.30.html'])
+        self.assertListEqual(log_analyzer.find_unreported_logs(self.config), [])
+
+        # a log over the errors budget fails and gets no report
+        with open(os.path.join(self.config.LOG_DIR, 'nginx-access-ui.log-20170701'), 'w') as log:
+            log.write('broken line\n' * 10)
+        config = namedtuple('Config', self.config._fields + ('ERRORS_LIMIT',))(*self.config, 0.5)
+        with self.assertLogs('test_log_analyzer', level='INFO') as logs:
+            log_analyzer.main_backfill(config, self.logger)
+        self.assertTrue(any('Failed to process' in line and '20170701' in line for line in logs.output))
+        self.assertFalse(any('is processed' in line for line in logs.output))
+        self.assertEqual(len(os.listdir(self.config.REPORT_DIR)), 2)
+
+    def test_day_cache_sketches(self):
+        self.write_logs()
+        log_meta = log_analyzer.find_log_by_date(self.config, '20170630')
+        statistic = log_analyzer.aggregate_log(log_meta, self.config, self.logger, day_cache=True)
+        exact = log_analyzer.aggregate_log(log_meta, self.config, self.logger)
+        self.assertIsInstance(statistic.store['/api/1'].samples, log_analyzer.SketchedSamples)
+        self.assertListEqual(list(log_analyzer.report_statistic(statistic, self.config)),
+                             list(log_analyzer.report_statistic(exact, self.config)))
+        sketched = log_analyzer.sketch_statistic(statistic, 0.01)
+        expected = log_analyzer.sketch_statistic(exact, 0.01)
+        for url, rec in expected.store.items():
+            self.assertDictEqual(sketched.store[url].samples.buckets, rec.samples.buckets)
+
+        # without CACHE_DIR the daily run does not cache anything
+        log_analyzer.main(self.config._replace(CACHE_DIR=None), self.logger)
+        self.assertListEqual(os.listdir(self.config.REPORT_DIR), ['report-2017.06.30.html'])
+        self.assertFalse(os.path.exists(self.config.CACHE_DIR))
+
+    def test_range_report(self):
+        self.write_logs()
+
+        log_analyzer.main_range(self.config, self.logger, '20170629..20170630')
+        self.assertTrue(os.path.exists(log_analyzer.day_cache_path(self.config, '20170629')))
+        statistic = log_analyzer.merge_statistic(
+            log_analyzer.load_day_cache(log_analyzer.day_cache_path(self.config, date))
+            for date in ('20170629', '20170630'))
+        self.assertEqual(statistic.url_count, 8)
+        self.assertEqual(statistic.store['/api/1'].count, 6)
+        self.assertIsInstance(statistic.store['/api/1'].samples, log_analyzer.QuantileSketch)
+        self.assertTrue(os.path.exists(os.path.join(self.config.REPORT_DIR, 'report-2017.06.29-2017.06.30.html')))
+
+        # the second run is built from the cache only
+        shutil.rmtree(self.config.LOG_DIR)
+        os.remove(os.path.join(self.config.REPORT_DIR, 'report-2017.06.29-2017.06.30.html'))
+        log_analyzer.main_range(self.config, self.logger, '20170629..20170630')
+        self.assertTrue(os.path.exists(os.path.join(self.config.REPORT_DIR, 'report-2017.06.29-2017.06.30.html')))
+
+
+    def test_range_report_spilled(self):
+        self.write_logs()
+        log_analyzer.main_range(self.config, self.logger, '20170629')
+        with open(os.path.join(self.config.LOG_DIR, 'nginx-access-ui.log-20170630'), 'w') as log:
+            log.writelines('1.196.116.32 -  - [30/Jun/2017:03:50:22 +0300] "GET /api/{} HTTP/1.1" 200 927 "-" '
+                           '"Lynx" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.5\n'.format(i)
+                           for i in range(25000))
+        config = namedtuple('Config', self.config._fields + ('MAX_MEMORY_MB',))(*self.config, 0.5)
+        log_analyzer.main_range(config, self.logger, '20170629..20170630')
+        self.assertTrue(os.path.exists(os.path.join(self.config.REPORT_DIR, 'report-2017.06.29-2017.06.30.html')))
+        statistic = log_analyzer.load_day_cache(log_analyzer.day_cache_path(self.config, '20170630'))
+        self.assertEqual(len(statistic.store), 25000)
+        self.assertIsInstance(statistic.store['/api/1'].samples, log_analyzer.QuantileSketch)
+
+
+class TestReport(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = namedtuple('Config', ['REPORT_DIR'])(REPORT_DIR=os.path.join(self.tmp_dir, 'reports'))
+        self.log_meta = log_analyzer.LogMeta(path='', date='20170630', expansion='')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_generate_report(self):
+        rows = [{'url': '/api/1', 'count': 1}, {'url': '/</script>', 'count': 2}]
+        log_analyzer.generate_report(iter(rows), self.config, self.log_meta, log_analyzer.REPORT_TEMPLATE_PATH)
+        self.assertListEqual(os.listdir(self.config.REPORT_DIR), ['report-2017.06.30.html'])
+        with open(os.path.join(self.config.REPORT_DIR, 'report-2017.06.30.html'), encoding='utf-8') as report:
+            html = report.read()
+        prefix, suffix = log_analyzer.load_template(log_analyzer.REPORT_TEMPLATE_PATH)
+        self.assertTrue(html.startswith(prefix) and html.endswith(suffix))
+        table_json = html[len(prefix):len(html) - len(suffix)]
+        self.assertNotIn('</script>', table_json)
+        self.assertListEqual(json.loads(table_json), rows)
+
+
+    def test_template_cache(self):
+        template_path = os.path.join(self.tmp_dir, 'template.html')
+        shutil.copy(log_analyzer.REPORT_TEMPLATE_PATH, template_path)
+        template = log_analyzer.load_template(template_path)
+        self.assertIs(log_analyzer.load_template(template_path), template)
+        with open(template_path, 'a', encoding='utf-8') as template_file:
+            template_file.write('<!-- changed -->')
+        self.assertTrue(log_analyzer.load_template(template_path)[1].endswith('<!-- changed -->'))
+
+    def test_report_data_file(self):
+        config = namedtuple('Config', ['REPORT_DIR', 'REPORT_DATA_FILE'])(REPORT_DIR=self.config.REPORT_DIR,
+                                                                        REPORT_DATA_FILE=True)
+        shell_path = os.path.join(config.REPORT_DIR, 'report-current.html')
+        for rows in ([{'url': '/api/1', 'count': 1}], [{'url': '/api/2', 'count': 2}]):
+            log_analyzer.generate_report(iter(rows), config, None, log_analyzer.REPORT_TEMPLATE_PATH,
+                                         report_name='report-current.html')
+            with open(os.path.join(config.REPORT_DIR, 'report-current.json'), encoding='utf-8') as data:
+                self.assertListEqual(json.load(data), rows)
+            if rows[0]['count'] == 1:
+                os.utime(shell_path, ns=(0, 0))
+        # the shell is not rewritten by a refresh
+        self.assertEqual(os.stat(shell_path).st_mtime_ns, 0)
+        with open(shell_path, encoding='utf-8') as shell:
+            self.assertIn('url: "report-current.json"', shell.read())
+        self.assertListEqual(sorted(os.listdir(config.REPORT_DIR)), ['report-current.html', 'report-current.json'])
+
+
 class TestEnv(unittest.TestCase):
     def setUp(self):
         config = {
@@ -103,6 +738,30 @@ class TestEnv(unittest.TestCase):
         self.assertTrue(is_report_exist, 'Should be True')
         self.del_reports(self.config)
 
+    def test_find_unreported_logs(self):
+        self.create_logs(self.config)
+        self.create_reports(self.config)
+        open(os.path.join(self.config.LOG_DIR, 'nginx-access-ui.log-20171345'), 'w').close()
+        log_metas = log_analyzer.find_unreported_logs(self.config)
+        self.assertListEqual([log_meta.path for log_meta in log_metas], ['./log_test/nginx-access-ui.log-20170701'])
+        self.assertEqual(log_metas[0].expansion, '')
+        self.del_logs(self.config)
+        self.del_reports(self.config)
+
+
+    def test_log_name_pattern(self):
+        config = namedtuple('Config', ['LOG_DIR', 'LOG_NAME_PATTERN'])(
+            LOG_DIR=self.config.LOG_DIR,
+            LOG_NAME_PATTERN=r'gateway-access\.(?P<year>\d{4})-(?P<month>\d\d)-(?P<day>\d\d)\.json(?P<extension>\.gz)?')
+        self.create_logs(self.config)
+        for file in ('gateway-access.2017-07-02.json.gz', 'gateway-access.2017-07-04.json.tmp'):
+            open(os.path.join(config.LOG_DIR, file), 'w').close()
+        log_meta = log_analyzer.find_last_log(config, self.logmeta)
+        self.assertEqual(log_meta.path, './log_test/gateway-access.2017-07-02.json.gz')
+        self.assertEqual((log_meta.date, log_meta.expansion), ('20170702', '.gz'))
+        self.assertEqual(log_analyzer.find_last_log(self.config, self.logmeta).date, '20170703')
+        self.del_logs(self.config)
+
 
 class TestFunction(unittest.TestCase):
     pass